@@ -1,3 +1,4 @@
+import re
 try:
     import json
 except (ImportError, NameError):
@@ -19,3 +20,323 @@ except AttributeError:
 
 loads = json.loads
 dumps = json.dumps
+
+
+_ARRAY_TOKENS = re.compile(r'[][{}",]')
+_STRING_TOKENS = re.compile(r'["\\]')
+
+
+def iter_array(read, loads=loads, buf='', chunk_size=64 * 1024):
+    """
+    Incrementally parses a JSON array, yielding each of its elements as soon
+    as it has been read.
+
+      read          returns the next `chunk_size` bytes of JSON text, or ''
+                    at the end of it
+      loads         parses the text of a single element
+      buf           text that was already read
+
+    Raises ValueError when the text is not a well-formed JSON array.
+    """
+    buf = buf.lstrip()
+    while not buf:
+        chunk = read(chunk_size)
+        if not chunk:
+            raise ValueError('No JSON object could be decoded')
+        buf = chunk.lstrip()
+    if buf[0] != '[':
+        raise ValueError('Expected a JSON array')
+    start = pos = 1 # of the current element and of the scan
+    depth = 0
+    in_string = False
+    elements = 0
+    while True:
+        m = (_STRING_TOKENS if in_string else _ARRAY_TOKENS).search(buf, pos)
+        if m is None or (in_string and m.group() == '\\' and m.end() == len(buf)):
+            chunk = read(chunk_size)
+            if not chunk:
+                raise ValueError('Unterminated JSON array')
+            # drop the elements that were already parsed
+            buf = buf[start:] + chunk
+            pos -= start
+            start = 0
+            continue
+        token = m.group()
+        pos = m.end()
+        if in_string:
+            if token == '"':
+                in_string = False
+            else: # skip the escaped character
+                pos += 1
+        elif token == '"':
+            in_string = True
+        elif token in '[{':
+            depth += 1
+        elif depth:
+            if token in ']}':
+                depth -= 1
+        elif token in ',]':
+            element = buf[start:m.start()].strip()
+            if element:
+                yield loads(element)
+                elements += 1
+            elif token == ',' or elements:
+                raise ValueError('Expected an array element')
+            start = pos
+            if token == ']':
+                break
+        else:
+            raise ValueError('Unexpected %r in JSON array' % token)
+    rest = buf[pos:]
+    while rest is not None:
+        if rest.strip():
+            raise ValueError('Extra data after JSON array')
+        rest = read(chunk_size) or None
+
+
+try:
+    from django.utils.encoding import force_unicode
+    from django.utils.functional import Promise
+except (ImportError, NameError):
+    Promise = None
+
+
+def fallback_default(json_encoder):
+    """
+    Returns a `default` hook for the codecs below. Native JSON values are
+    serialized by the codec itself, only the rest (datetimes, decimals,
+    lazy translation strings...) go through `json_encoder.default`.
+    """
+    encoder_default = json_encoder().default
+    def default(o):
+        if Promise is not None and isinstance(o, Promise):
+            return force_unicode(o)
+        return encoder_default(o)
+    return default
+
+
+# what a JSON encoder class can customize besides `default`
+_ENCODER_ATTRIBUTES = ('__init__', 'encode', 'iterencode',
+                       'item_separator', 'key_separator')
+_ENCODER_MODULES = ('json.encoder', 'simplejson.encoder',
+                    'django.utils.simplejson.encoder')
+
+
+def encodes_by_default(json_encoder):
+    """
+    Whether `json_encoder` customizes nothing but its `default` method, so
+    the codecs can serialize with `fallback_default` instead of with it.
+    """
+    for klass in getattr(json_encoder, '__mro__', ()):
+        if klass.__module__ in _ENCODER_MODULES:
+            return True
+        if [name for name in _ENCODER_ATTRIBUTES if name in vars(klass)]:
+            return False
+    return False
+
+
+class Codec(object):
+    """
+    A serialization backend for JSON-RPC requests and responses.
+
+      name          the name the codec is registered with
+      content_type  the content type of serialized data
+      content_types other content types the codec is negotiated by
+      incremental   whether a batch can be parsed entry by entry with
+                    `iter_array`, only true of the JSON codecs
+    """
+    name = None
+    content_type = 'application/json-rpc'
+    content_types = ()
+    incremental = True
+
+    def loads(self, data):
+        raise NotImplementedError
+
+    def dumps(self, obj, default=None):
+        raise NotImplementedError
+
+    def dumps_array(self, items):
+        "Joins serialized values `items` into a serialized array of them"
+        return '[%s]' % ', '.join(items)
+
+    def stream_array(self, items):
+        "Yields a serialized array of the serialized values `items` piece by piece"
+        yield '['
+        separator = ''
+        for item in items:
+            yield separator + item
+            separator = ', '
+        yield ']'
+
+
+class StdlibCodec(Codec):
+    """ The `json` module picked above, C-accelerated where available """
+    name = 'json'
+
+    def loads(self, data):
+        return loads(data)
+
+    def dumps(self, obj, default=None):
+        return dumps(obj, default=default)
+
+
+class SimplejsonCodec(Codec):
+    """
+    simplejson with its C speedups. Decimals are left to the `default`
+    hook, like with the other codecs.
+    """
+    name = 'simplejson'
+
+    def __init__(self):
+        import simplejson
+        self.json = simplejson
+
+    def loads(self, data):
+        return self.json.loads(data)
+
+    def dumps(self, obj, default=None):
+        return self.json.dumps(obj, default=default, use_decimal=False)
+
+
+class UjsonCodec(Codec):
+    """
+    ujson. Releases without a `default` hook serialize datetimes, decimals
+    and arbitrary objects as something else instead of failing, so the
+    codec is only available with releases that have one.
+    """
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        try:
+            ujson.dumps(None, default=None)
+        except TypeError:
+            raise ImportError('ujson %s has no default hook' %
+                              getattr(ujson, '__version__', ''))
+        self.json = ujson
+
+    def loads(self, data):
+        return self.json.loads(data)
+
+    def dumps(self, obj, default=None):
+        return self.json.dumps(obj, default=default)
+
+
+class EncoderCodec(Codec):
+    """
+    Serializes like the JSON `codec`, but with the `json_encoder` class
+    itself, for encoders that customize more than `default` (separators,
+    `ensure_ascii`, `encode`...). Slower than `codec`.
+    """
+    def __init__(self, codec, json_encoder):
+        self.codec = codec
+        self.json_encoder = json_encoder
+        self.name = codec.name
+        self.content_type = codec.content_type
+        self.content_types = codec.content_types
+
+    def loads(self, data):
+        return self.codec.loads(data)
+
+    def dumps(self, obj, default=None):
+        return dumps(obj, cls=self.json_encoder)
+
+
+class MsgpackCodec(Codec):
+    """
+    MessagePack, smaller and quicker than JSON for numbers and nested
+    data. Strings are sent as raw and decoded to unicode. An array is
+    prefixed with its length, so a streamed batch is sent once complete.
+    """
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+    content_types = ('application/x-msgpack', 'application/vnd.msgpack')
+    incremental = False
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+        try:
+            msgpack.unpackb(msgpack.packb(None), raw=False)
+        except TypeError: # before msgpack 0.5.2
+            self.unpack_options = {'encoding': 'utf-8'}
+        else:
+            self.unpack_options = {'raw': False}
+
+    def loads(self, data):
+        return self.msgpack.unpackb(data, **self.unpack_options)
+
+    def dumps(self, obj, default=None):
+        return self.msgpack.packb(obj, default=default, use_bin_type=False)
+
+    def dumps_array(self, items):
+        items = list(items)
+        return self.msgpack.Packer().pack_array_header(len(items)) + ''.join(items)
+
+    def stream_array(self, items):
+        yield self.dumps_array(items)
+
+
+class CborCodec(Codec):
+    """
+    CBOR with cbor2. Arrays of unknown length are sent with an indefinite
+    length, so a batch can be streamed entry by entry.
+    """
+    name = 'cbor'
+    content_type = 'application/cbor'
+    incremental = False
+
+    def __init__(self):
+        import cbor2
+        self.cbor = cbor2
+
+    def loads(self, data):
+        return self.cbor.loads(data)
+
+    def dumps(self, obj, default=None):
+        if default is None:
+            return self.cbor.dumps(obj)
+        return self.cbor.dumps(obj, default=lambda encoder, o: encoder.encode(default(o)))
+
+    def dumps_array(self, items):
+        return ''.join(self.stream_array(items))
+
+    def stream_array(self, items):
+        yield '\x9f'
+        for item in items:
+            yield item
+        yield '\xff'
+
+
+codecs = {}
+
+
+def register_codec(codec):
+    """ Makes `codec` available by its name to `get_codec` """
+    codecs[codec.name] = codec
+    return codec
+
+
+def get_codec(codec):
+    """ Returns the codec registered as `codec`, or `codec` if it is one """
+    if isinstance(codec, Codec):
+        return codec
+    try:
+        return codecs[codec]
+    except KeyError:
+        raise ValueError('Unknown codec %r, available codecs are: %s' %
+                         (codec, ', '.join(sorted(codecs))))
+
+
+def media_type(content_type):
+    "The media type of a Content-Type header value, without its parameters"
+    return content_type.split(';', 1)[0].strip().lower()
+
+
+register_codec(StdlibCodec())
+for codec_class in (SimplejsonCodec, UjsonCodec, MsgpackCodec, CborCodec):
+    try:
+        register_codec(codec_class())
+    except ImportError:
+        pass
@@ -0,0 +1,172 @@
+import os
+import hmac
+import time
+from copy import copy
+from hashlib import sha256
+from threading import Lock
+from uuid import uuid4
+from collections import deque
+from django.contrib.auth import authenticate
+from django.db.models.signals import post_save, post_delete
+from django.utils.encoding import smart_str
+try:
+    from django.contrib.auth import get_user_model
+except ImportError: # Django < 1.5
+    from django.contrib.auth.models import User
+    get_user_model = lambda: User
+
+
+def credentials_digest(salt, username, password):
+    """ A salted digest of a pair of credentials, used in place of them """
+    return hmac.new(salt, '%s\0%s' % (smart_str(username), smart_str(password)),
+                    sha256).digest()
+
+
+class AuthenticationCache(object):
+    """
+    A bounded cache of successful `authenticate` calls, so that repeated
+    calls with the same credentials don't run the password hasher again.
+
+      max_size      the maximum number of credentials remembered
+      ttl           seconds before credentials are verified again
+      authenticate  the function verifying credentials, it takes the
+                    keyword arguments `username` and `password` and returns
+                    a user or None
+      cache         a Django cache shared between processes, see below
+      key_prefix    prepended to the keys in `cache`
+
+    Credentials are remembered by a digest salted with a random key that
+    is never stored. All cached credentials of a user are forgotten when
+    the user is saved or deleted, ie. when its password or active flag
+    changes. Saves are only seen in the process making them, other
+    processes keep accepting the old credentials for up to `ttl` seconds.
+    With a `cache` each user has a generation in it that saves move on,
+    so that all processes forget the user's credentials, at the price of
+    a cache lookup per call.
+    """
+    generation_timeout = 30 * 24 * 60 * 60
+
+    def __init__(self, max_size=1000, ttl=60, authenticate=authenticate,
+                 cache=None, key_prefix='jsonrpc'):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._authenticate = authenticate
+        self.cache = cache
+        self.key_prefix = key_prefix
+        self._salt = os.urandom(32)
+        self._entries = {}   # digest -> (expires, user)
+        self._order = deque() # (expires, digest) in insertion order
+        self._user_keys = {} # user pk -> set of digests
+        self._lock = Lock()
+        user_model = get_user_model()
+        post_save.connect(self.user_changed, sender=user_model)
+        post_delete.connect(self.user_changed, sender=user_model)
+
+    def authenticate(self, username=None, password=None):
+        key = credentials_digest(self._salt, username, password)
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > now and \
+                entry[2] == self._generation(entry[1]):
+            return copy(entry[1])
+        user = self._authenticate(username=username, password=password)
+        if user is not None:
+            self._store(key, now + self.ttl, user, self._generation(user))
+        return user
+
+    def _generation_key(self, user):
+        return '%s:auth:generation:%s' % (self.key_prefix, user.pk)
+
+    def _generation(self, user):
+        "The generation of `user` in the shared `cache`, None without one"
+        if self.cache is None:
+            return None
+        generation_key = self._generation_key(user)
+        generation = self.cache.get(generation_key)
+        if generation is None:
+            self.cache.add(generation_key, uuid4().hex, self.generation_timeout)
+            generation = self.cache.get(generation_key)
+        return generation
+
+    def _store(self, key, expires, user, generation=None):
+        self._lock.acquire()
+        try:
+            self._discard(key)
+            self._entries[key] = (expires, copy(user), generation)
+            self._order.append((expires, key))
+            self._user_keys.setdefault(user.pk, set()).add(key)
+            while len(self._entries) > self.max_size:
+                expires, key = self._order.popleft()
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] == expires:
+                    self._discard(key)
+            if len(self._order) > 2 * self.max_size: # drop replaced entries
+                self._order = deque(sorted([(entry[0], key) for key, entry
+                                            in self._entries.iteritems()]))
+        finally:
+            self._lock.release()
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            keys = self._user_keys.get(entry[1].pk)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._user_keys[entry[1].pk]
+
+    def invalidate_user(self, user):
+        """ Forgets all credentials of `user`, in all processes with a `cache` """
+        if self.cache is not None:
+            self.cache.set(self._generation_key(user), uuid4().hex, self.generation_timeout)
+        self._lock.acquire()
+        try:
+            for key in list(self._user_keys.get(user.pk, ())):
+                self._discard(key)
+        finally:
+            self._lock.release()
+
+    def user_changed(self, sender, instance, **kwargs):
+        self.invalidate_user(instance)
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._order.clear()
+            self._user_keys.clear()
+        finally:
+            self._lock.release()
+
+
+class AuthenticationContext(object):
+    """
+    Remembers the credentials verified while answering a single HTTP
+    request, so that the entries of a batch carrying the same credentials
+    only verify them once. Failures are remembered too, every entry using
+    them still fails.
+    """
+
+    def __init__(self):
+        self._results = {}
+        self._locks = {}
+        self._lock = Lock()
+
+    def authenticate(self, authenticate, username=None, password=None):
+        key = (authenticate, username, password)
+        self._lock.acquire()
+        try:
+            if key in self._results:
+                return self._results[key]
+            key_lock = self._locks.setdefault(key, Lock())
+        finally:
+            self._lock.release()
+        # concurrent entries with the same credentials wait for the first
+        key_lock.acquire()
+        try:
+            if key not in self._results:
+                self._results[key] = authenticate(username=username,
+                                                  password=password)
+            return self._results[key]
+        finally:
+            key_lock.release()
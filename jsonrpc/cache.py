@@ -0,0 +1,179 @@
+import time
+from uuid import uuid4
+from hashlib import md5
+from itertools import count
+from threading import Lock, Event
+from collections import deque
+from jsonrpc._json import dumps
+
+
+def result_key(args, kwargs):
+    """ A digest of the normalized params of a call """
+    return md5(dumps([args, kwargs], sort_keys=True)).hexdigest()
+
+
+class ResultCache(object):
+    """
+    Remembers the results of idempotent methods registered with a
+    `cache_timeout`. Only one caller computes a missing result, others
+    asking for it meanwhile wait for that result.
+    """
+
+    def get_or_call(self, method_name, key, func, timeout):
+        """
+        Returns the result cached for `key` of `method_name` or calls `func`
+        and caches what it returns for `timeout` seconds.
+        """
+        raise NotImplementedError
+
+    def invalidate(self, method_names):
+        """ Forgets all results of the given methods """
+        raise NotImplementedError
+
+
+class LocMemResultCache(ResultCache):
+    """
+    An in-process cache of at most `max_size` results, evicting the least
+    recently used ones first. Callers wait at most `lock_timeout` seconds
+    for the caller that is computing a result before computing it
+    themselves.
+    """
+
+    def __init__(self, max_size=1000, lock_timeout=10):
+        self.max_size = max_size
+        self.lock_timeout = lock_timeout
+        self._entries = {}    # (method name, key) -> [expires, result, tick]
+        self._order = deque() # (tick, (method name, key)) in order of use
+        self._ticks = count()
+        self._pending = {}    # (method name, key) -> Event
+        self._lock = Lock()
+
+    def get_or_call(self, method_name, key, func, timeout):
+        key = (method_name, key)
+        deadline = time.time() + self.lock_timeout
+        while True:
+            self._lock.acquire()
+            try:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > time.time():
+                    self._touch(key, entry)
+                    return entry[1]
+                pending = self._pending.get(key)
+                if pending is None:
+                    pending = self._pending[key] = Event()
+                    break
+            finally:
+                self._lock.release()
+            # somebody else is computing the result, once they are done it is
+            # cached or, if they failed, we try ourselves
+            pending.wait(max(deadline - time.time(), 0))
+            if not pending.is_set(): # they hang, don't hang with them
+                return func()
+        try:
+            result = func()
+            self._lock.acquire()
+            try:
+                entry = [time.time() + timeout, result, None]
+                self._entries[key] = entry
+                self._touch(key, entry)
+                self._evict()
+            finally:
+                self._lock.release()
+            return result
+        finally:
+            self._lock.acquire()
+            try:
+                del self._pending[key]
+            finally:
+                self._lock.release()
+            pending.set()
+
+    def _touch(self, key, entry):
+        entry[2] = self._ticks.next()
+        self._order.append((entry[2], key))
+
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            tick, key = self._order.popleft()
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] == tick:
+                del self._entries[key]
+        if len(self._order) > 2 * self.max_size: # drop stale ticks
+            self._order = deque(sorted([(entry[2], key) for key, entry
+                                        in self._entries.iteritems()]))
+
+    def invalidate(self, method_names):
+        method_names = set(method_names)
+        self._lock.acquire()
+        try:
+            for key in [key for key in self._entries if key[0] in method_names]:
+                del self._entries[key]
+        finally:
+            self._lock.release()
+
+
+class DjangoResultCache(ResultCache):
+    """
+    Caches results with Django's cache framework, so that they are shared
+    between processes.
+
+      cache         the cache to use, defaults to `django.core.cache.cache`
+      key_prefix    prepended to all keys
+      lock_timeout  the seconds other callers wait for the caller that is
+                    computing a result before computing it themselves
+    """
+    generation_timeout = 30 * 24 * 60 * 60
+
+    def __init__(self, cache=None, key_prefix='jsonrpc', lock_timeout=10,
+                 poll_interval=0.05):
+        if cache is None:
+            from django.core.cache import cache
+        self.cache = cache
+        self.key_prefix = key_prefix
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+
+    def _generation_key(self, method_name):
+        return '%s:generation:%s' % (self.key_prefix, md5(method_name.encode('utf-8')).hexdigest())
+
+    def _key(self, method_name, key):
+        # results are invalidated by moving their method to a new generation,
+        # a random one so that results of a forgotten generation are orphaned
+        generation_key = self._generation_key(method_name)
+        generation = self.cache.get(generation_key)
+        if generation is None:
+            self.cache.add(generation_key, uuid4().hex, self.generation_timeout)
+            generation = self.cache.get(generation_key)
+        return '%s:result:%s:%s:%s' % (self.key_prefix,
+                                       md5(method_name.encode('utf-8')).hexdigest(),
+                                       generation, key)
+
+    def get_or_call(self, method_name, key, func, timeout):
+        key = self._key(method_name, key)
+        lock_key = key + ':lock'
+        deadline = time.time() + self.lock_timeout
+        while True:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached[0]
+            if self.cache.add(lock_key, 1, self.lock_timeout):
+                # the caller that held the lock may have just cached the result
+                cached = self.cache.get(key)
+                if cached is not None:
+                    self.cache.delete(lock_key)
+                    return cached[0]
+                break
+            if time.time() > deadline:
+                return func()
+            time.sleep(self.poll_interval)
+        try:
+            result = func()
+            self.cache.set(key, (result,), timeout)
+            return result
+        finally:
+            self.cache.delete(lock_key)
+
+    def invalidate(self, method_names):
+        for method_name in method_names:
+            self.cache.set(self._generation_key(method_name), uuid4().hex,
+                           self.generation_timeout)
@@ -0,0 +1,269 @@
+import zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# the most a compressed body may expand to, against decompression bombs
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
+
+class Encoding(object):
+    """
+    A content coding of HTTP bodies, as named in the Accept-Encoding and
+    Content-Encoding headers.
+    """
+    name = None
+
+    def compress(self, data):
+        raise NotImplementedError
+
+    def decompress(self, data, max_size=MAX_DECOMPRESSED_SIZE):
+        raise NotImplementedError
+
+    def compress_stream(self, chunks):
+        "Yields the compressed body made of `chunks`, flushed after each chunk"
+        yield self.compress(''.join(chunks))
+
+    def decompressor(self, max_size=MAX_DECOMPRESSED_SIZE):
+        "A `Decompressor` of this encoding"
+        return Decompressor(self, max_size)
+
+
+class Decompressor(object):
+    """
+    Decompresses a body fed to it chunk by chunk. This one decompresses the
+    whole body when it is flushed, encodings that can do better override
+    `Encoding.decompressor`.
+    """
+
+    def __init__(self, encoding, max_size):
+        self.encoding = encoding
+        self.max_size = max_size
+        self.chunks = []
+
+    def decompress(self, chunk):
+        self.chunks.append(chunk)
+        return ''
+
+    def flush(self):
+        return self.encoding.decompress(''.join(self.chunks), self.max_size)
+
+
+class ZlibEncoding(Encoding):
+    """
+    gzip or deflate, `wbits` selects the container format. Decompressing
+    deflate also accepts raw deflate data, which some clients send.
+    """
+
+    def __init__(self, name, wbits, level=6):
+        self.name = name
+        self.wbits = wbits
+        self.level = level
+
+    def compress(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, self.wbits)
+        return compressor.compress(data) + compressor.flush()
+
+    def compress_stream(self, chunks):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, self.wbits)
+        for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def decompress(self, data, max_size=MAX_DECOMPRESSED_SIZE):
+        decompressor = self.decompressor(max_size)
+        return decompressor.decompress(data) + decompressor.flush()
+
+    def decompressor(self, max_size=MAX_DECOMPRESSED_SIZE):
+        return ZlibDecompressor(self.wbits, max_size)
+
+
+class ZlibDecompressor(object):
+    """ Decompresses gzip or deflate data incrementally, up to `max_size` bytes """
+
+    def __init__(self, wbits, max_size):
+        self.wbits = wbits
+        self.max_size = max_size
+        self.size = 0
+        self.started = False
+        self._decompressor = zlib.decompressobj(wbits)
+
+    def decompress(self, chunk):
+        if not self.started and chunk:
+            self.started = True
+            if self.wbits == zlib.MAX_WBITS and not _zlib_header(chunk):
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        try:
+            data = self._decompressor.decompress(chunk, self.max_size - self.size + 1)
+        except zlib.error, e:
+            raise ValueError(str(e))
+        self.size += len(data)
+        if self.size > self.max_size or self._decompressor.unconsumed_tail:
+            raise ValueError('The body is larger than %d bytes decompressed' % self.max_size)
+        return data
+
+    def flush(self):
+        try:
+            return self._decompressor.flush()
+        except zlib.error, e:
+            raise ValueError(str(e))
+
+
+def _zlib_header(data):
+    "Whether `data` starts with a zlib header rather than raw deflate data"
+    return (len(data) >= 2 and ord(data[0]) & 0x0f == 8 and
+            (ord(data[0]) * 256 + ord(data[1])) % 31 == 0)
+
+
+class ZstdEncoding(Encoding):
+    name = 'zstd'
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor().compress(data)
+
+    def compress_stream(self, chunks):
+        compressor = zstandard.ZstdCompressor().compressobj()
+        for chunk in chunks:
+            data = compressor.compress(chunk) + \
+                   compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def decompress(self, data, max_size=MAX_DECOMPRESSED_SIZE):
+        reader = zstandard.ZstdDecompressor().stream_reader(data)
+        data = reader.read(max_size + 1)
+        if len(data) > max_size:
+            raise ValueError('The body is larger than %d bytes decompressed' % max_size)
+        return data
+
+
+class BrotliEncoding(Encoding):
+    name = 'br'
+
+    def compress(self, data):
+        return brotli.compress(data)
+
+    def compress_stream(self, chunks):
+        compressor = brotli.Compressor()
+        for chunk in chunks:
+            data = compressor.process(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+
+    def decompress(self, data, max_size=MAX_DECOMPRESSED_SIZE):
+        decompressor = self.decompressor(max_size)
+        return decompressor.decompress(data) + decompressor.flush()
+
+    def decompressor(self, max_size=MAX_DECOMPRESSED_SIZE):
+        return BrotliDecompressor(max_size)
+
+
+class BrotliDecompressor(object):
+    """
+    Decompresses brotli data incrementally, up to `max_size` bytes. The
+    brotli module can't limit the output of a call, so input is fed in
+    small slices and the size checked after each.
+    """
+    slice_size = 1024
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._decompressor = brotli.Decompressor()
+
+    def decompress(self, chunk):
+        data = []
+        for start in xrange(0, len(chunk), self.slice_size):
+            try:
+                data.append(self._decompressor.process(chunk[start:start + self.slice_size]))
+            except brotli.error, e:
+                raise ValueError(str(e))
+            self.size += len(data[-1])
+            if self.size > self.max_size:
+                raise ValueError('The body is larger than %d bytes decompressed' % self.max_size)
+        return ''.join(data)
+
+    def flush(self):
+        if not self._decompressor.is_finished():
+            raise ValueError('Truncated brotli data')
+        return ''
+
+
+# the encodings available, in the order of preference
+encodings = {}
+preference = []
+
+
+def register_encoding(encoding):
+    "Makes `encoding` available, preferred to those registered before it"
+    encodings[encoding.name] = encoding
+    if encoding.name in preference:
+        preference.remove(encoding.name)
+    preference.insert(0, encoding.name)
+
+
+register_encoding(ZlibEncoding('deflate', zlib.MAX_WBITS))
+register_encoding(ZlibEncoding('gzip', 16 + zlib.MAX_WBITS))
+if brotli is not None:
+    register_encoding(BrotliEncoding())
+if zstandard is not None:
+    register_encoding(ZstdEncoding())
+
+
+def negotiate(accept_encoding):
+    """
+    The name of the available encoding an Accept-Encoding header value
+    prefers, or None if the body should not be compressed.
+    """
+    weights = {}
+    for item in accept_encoding.split(','):
+        parts = item.split(';')
+        name = parts[0].strip().lower()
+        weight = 1.0
+        for param in parts[1:]:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        if name:
+            weights[name] = weight
+    best, best_weight = None, 0.0
+    for name in preference:
+        weight = weights.get(name, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = name, weight
+    return best
+
+
+def decompressing_reader(read, name, max_size=MAX_DECOMPRESSED_SIZE):
+    """
+    Returns a `read(size)` function over the decompressed data of the body
+    `read` reads, compressed with the encoding `name`.
+    """
+    if name not in encodings:
+        raise ValueError('Unsupported content encoding %r' % name)
+    decompressor = encodings[name].decompressor(max_size)
+    state = {'buffer': '', 'done': False}
+    def read_decompressed(size):
+        while len(state['buffer']) < size and not state['done']:
+            chunk = read(size)
+            if chunk:
+                state['buffer'] += decompressor.decompress(chunk)
+            else:
+                state['buffer'] += decompressor.flush()
+                state['done'] = True
+        data, state['buffer'] = state['buffer'][:size], state['buffer'][size:]
+        return data
+    return read_decompressed
@@ -88,6 +88,20 @@ class ServerError(Error):
 # -32099..-32000    Server error.     Reserved for implementation-defined server-errors.
 
 
+class MethodTimeoutError(Error):
+    """ The method did not finish within its timeout. """
+    code = -32000
+    message = _('Method timed out.')
+    status = 504
+
+
+class ServerBusyError(Error):
+    """ Too many calls with a timeout are running to start another one. """
+    code = -32001
+    message = _('Server busy, try again later.')
+    status = 503
+
+
 # The remainder of the space is available for application defined errors.
 
 
@@ -0,0 +1,152 @@
+import sys
+from copy import copy
+from collections import deque
+from threading import Lock, Thread, Event, BoundedSemaphore
+from multiprocessing.pool import ThreadPool
+from django.utils import translation
+from jsonrpc.exceptions import MethodTimeoutError, ServerBusyError
+try:
+    from django.db import connections
+    def close_connections():
+        for connection in connections.all():
+            connection.close()
+except ImportError:
+    from django.db import connection
+    close_connections = connection.close
+
+
+class ThreadedExecutor(object):
+    """
+    Runs the entries of a batch request concurrently in a pool of threads.
+
+      max_workers   the maximum number of entries that run at once
+      max_pending   the maximum number of entries submitted to the pool
+                    ahead of the one whose result is awaited, defaults to
+                    twice `max_workers`
+
+    Each entry runs with a database connection of its own which is closed
+    when the entry is done, so methods that need to share the transaction
+    of the request should be registered with `concurrent=False`.
+    """
+
+    def __init__(self, max_workers=8, max_pending=None):
+        self.max_workers = max_workers
+        self.max_pending = max_pending or max_workers * 2
+        self._pool = None
+        self._lock = Lock()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._lock.acquire()
+            try:
+                if self._pool is None:
+                    self._pool = ThreadPool(self.max_workers)
+            finally:
+                self._lock.release()
+        return self._pool
+
+    def imap(self, func, iterable, inline=None):
+        """
+        Yields `func(item)` for every item of `iterable`, in order. Items for
+        which `inline(item)` is true are run in the calling thread.
+
+        If iterating `iterable` fails, the results of the items already
+        submitted are yielded before the error is raised.
+        """
+        pending = deque()
+        try:
+            for item in iterable:
+                if inline is not None and inline(item):
+                    pending.append(_Result(func(item)))
+                else:
+                    pending.append(self.pool.apply_async(_run, (func, item)))
+                while len(pending) > self.max_pending:
+                    yield pending.popleft().get()
+        except Exception:
+            exc_info = sys.exc_info()
+            while pending:
+                yield pending.popleft().get()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        """ Stops the worker threads once they are done """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+
+class _Result(object):
+    """ The result of an entry which was run in the calling thread """
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+def _run(func, item):
+    try:
+        return func(item)
+    finally:
+        close_connections()
+
+
+class TimeoutExecutor(object):
+    """
+    Runs calls that have a timeout, each in a thread of its own.
+
+      max_threads   the maximum number of calls running at once, including
+                    calls that timed out but haven't returned yet. Calls
+                    beyond it fail right away with a `ServerBusyError`
+                    rather than piling up threads and database connections
+    """
+
+    def __init__(self, max_threads=32):
+        self.max_threads = max_threads
+        self._slots = BoundedSemaphore(max_threads)
+
+    def call(self, func, timeout, request, *args, **kwargs):
+        """
+        Calls `func` with a shallow copy of `request` in a thread of its own
+        and raises a `MethodTimeoutError` if it doesn't return within
+        `timeout` seconds. The thread has a database connection of its own
+        and the active language of the calling thread.
+
+        Python can't stop a thread, so a call that timed out runs on in the
+        background. The `request.jsonrpc_cancelled` of the call is set when
+        it times out, long running methods can check it to give up early.
+        """
+        if not self._slots.acquire(False):
+            raise ServerBusyError('%d calls are running already.' % self.max_threads)
+        request = copy(request) # the Event is the call's, not the batch's
+        cancelled = request.jsonrpc_cancelled = Event()
+        language = translation.get_language()
+        outcome = []
+        def target():
+            translation.activate(language)
+            try:
+                outcome.append((True, func(request, *args, **kwargs)))
+            except:
+                outcome.append((False, sys.exc_info()))
+            translation.deactivate()
+            close_connections()
+            self._slots.release()
+        thread = Thread(target=target)
+        thread.daemon = True
+        try:
+            thread.start()
+        except:
+            self._slots.release()
+            raise
+        thread.join(timeout)
+        if not outcome:
+            cancelled.set()
+            raise MethodTimeoutError('Method timed out after %s seconds.' % timeout)
+        ok, value = outcome[0]
+        if not ok:
+            raise value[0], value[1], value[2]
+        return value
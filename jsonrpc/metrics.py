@@ -0,0 +1,141 @@
+from bisect import bisect_left
+from threading import Lock
+from timeit import default_timer
+
+
+PHASES = ('parse', 'normalize', 'validate', 'execute', 'serialize', 'total')
+
+
+class CallTimer(object):
+    """
+    Times the phases of a single call, see `PHASES`.
+
+      method        the name of the method called, '(unknown)' for calls
+                    of methods that don't exist and '(batch)' for the
+                    parsing of a batch request
+      timings       seconds spent in each phase
+      error         whether the call failed
+    """
+    __slots__ = ('method', 'timings', 'error', 'start', 'last')
+
+    def __init__(self, method=u'(unknown)'):
+        self.method = method
+        self.timings = {}
+        self.error = False
+        self.start = self.last = default_timer()
+
+    def mark(self, phase):
+        "Records the time since the previous mark as spent in `phase`"
+        now = default_timer()
+        self.timings[phase] = self.timings.get(phase, 0) + now - self.last
+        self.last = now
+
+    def skip(self):
+        "Leaves the time since the previous mark out of all phases but 'total'"
+        self.last = default_timer()
+
+
+class Instrumentation(object):
+    """
+    Hooks called around every call a `JsonRpcSite` handles.
+
+      pre_call      functions called as `hook(request, method_name)` before
+                    a call is run
+      post_call     functions called as `hook(request, timer)` with the
+                    `CallTimer` of a call once its response is serialized
+      metrics       a `MetricsRegistry` aggregating the timings, it is added
+                    to `post_call`
+    """
+
+    def __init__(self, pre_call=None, post_call=None, metrics=None):
+        self.pre_call = list(pre_call or [])
+        self.post_call = list(post_call or [])
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.post_call.append(self.metrics.observe)
+
+    def start(self, request, method_name):
+        for hook in self.pre_call:
+            hook(request, method_name)
+
+    def finish(self, request, timer, response=None):
+        if response is not None:
+            timer.error = response.get('error') is not None
+        timer.timings['total'] = default_timer() - timer.start
+        for hook in self.post_call:
+            hook(request, timer)
+
+
+class MetricsRegistry(object):
+    """
+    Per-method call counters and latency histograms of each phase, exported
+    in the Prometheus text format by `prometheus`.
+    """
+    buckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1,
+               2.5, 5, 10)
+
+    def __init__(self, buckets=None):
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+        self._calls = {}      # (method, outcome) -> count
+        self._histograms = {} # (method, phase) -> [bucket counts, sum, count]
+        self._lock = Lock()
+
+    def observe(self, request, timer):
+        outcome = timer.error and 'error' or 'ok'
+        self._lock.acquire()
+        try:
+            key = (timer.method, outcome)
+            self._calls[key] = self._calls.get(key, 0) + 1
+            for phase, seconds in timer.timings.iteritems():
+                histogram = self._histograms.get((timer.method, phase))
+                if histogram is None:
+                    histogram = [[0] * len(self.buckets), 0.0, 0]
+                    self._histograms[(timer.method, phase)] = histogram
+                index = bisect_left(self.buckets, seconds)
+                if index < len(self.buckets):
+                    histogram[0][index] += 1
+                histogram[1] += seconds
+                histogram[2] += 1
+        finally:
+            self._lock.release()
+
+    def prometheus(self):
+        "The metrics in the Prometheus text exposition format"
+        self._lock.acquire()
+        try:
+            calls = sorted(self._calls.items())
+            histograms = sorted([(key, (list(h[0]), h[1], h[2]))
+                                 for key, h in self._histograms.items()])
+        finally:
+            self._lock.release()
+        lines = ['# HELP jsonrpc_calls_total JSON-RPC calls by method and outcome.',
+                 '# TYPE jsonrpc_calls_total counter']
+        for (method, outcome), count in calls:
+            lines.append('jsonrpc_calls_total{method="%s",outcome="%s"} %d' %
+                         (_label(method), outcome, count))
+        lines += ['# HELP jsonrpc_phase_seconds Time spent in each phase of JSON-RPC calls.',
+                  '# TYPE jsonrpc_phase_seconds histogram']
+        for (method, phase), (buckets, total, count) in histograms:
+            labels = 'method="%s",phase="%s"' % (_label(method), phase)
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, buckets):
+                cumulative += bucket
+                lines.append('jsonrpc_phase_seconds_bucket{%s,le="%s"} %d' %
+                             (labels, bound, cumulative))
+            lines.append('jsonrpc_phase_seconds_bucket{%s,le="+Inf"} %d' % (labels, count))
+            lines.append('jsonrpc_phase_seconds_sum{%s} %r' % (labels, total))
+            lines.append('jsonrpc_phase_seconds_count{%s} %d' % (labels, count))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._calls.clear()
+            self._histograms.clear()
+        finally:
+            self._lock.release()
+
+
+def _label(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"') \
+                         .replace('\n', '\\n').encode('utf-8')
@@ -0,0 +1,182 @@
+import os
+import re
+import sys
+import pstats
+from random import random
+from cProfile import Profile
+from threading import Lock, Thread, Event
+from thread import get_ident
+
+
+class Profiler(object):
+    """
+    Profiles a random `rate` of the calls a `JsonRpcSite` answers and
+    aggregates the profiles per method name.
+    """
+
+    def __init__(self, rate=0.01):
+        self.rate = rate
+        self._lock = Lock()
+
+    def sample(self):
+        "Whether to profile the next call"
+        return random() < self.rate
+
+    def profile(self, method_name, func, *args, **kwargs):
+        "Calls `func(*args, **kwargs)` and adds its profile to `method_name`'s"
+        raise NotImplementedError
+
+    def methods(self):
+        "The names of the methods profiled so far"
+        raise NotImplementedError
+
+    def dump(self, directory):
+        "Writes the profile of each method to a file of its own in `directory`"
+        raise NotImplementedError
+
+    def reset(self):
+        raise NotImplementedError
+
+    def filename(self, method_name, extension):
+        return re.sub(r'[^\w.-]', '_', method_name) + extension
+
+
+class CProfileProfiler(Profiler):
+    """
+    Profiles calls with `cProfile`. `dump` writes a `<method>.prof` file of
+    pstats for each method, readable with `pstats.Stats` or snakeviz.
+    """
+
+    def __init__(self, rate=0.01):
+        super(CProfileProfiler, self).__init__(rate)
+        self._stats = {} # method name -> pstats.Stats
+
+    def profile(self, method_name, func, *args, **kwargs):
+        profile = Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self._lock.acquire()
+            try:
+                if method_name in self._stats:
+                    self._stats[method_name].add(profile)
+                else:
+                    self._stats[method_name] = pstats.Stats(profile)
+            finally:
+                self._lock.release()
+
+    def stats(self, method_name):
+        "The aggregated `pstats.Stats` of `method_name`, or None"
+        return self._stats.get(method_name)
+
+    def methods(self):
+        return sorted(self._stats)
+
+    def dump(self, directory):
+        self._lock.acquire()
+        try:
+            for method_name, stats in self._stats.items():
+                stats.dump_stats(os.path.join(directory,
+                                 self.filename(method_name, '.prof')))
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._stats.clear()
+        finally:
+            self._lock.release()
+
+
+class SamplingProfiler(Profiler):
+    """
+    Samples the stack of the calling thread every `interval` seconds while a
+    call runs. Cheaper than `cProfile` for long calls, but calls shorter
+    than `interval` go unseen. `dump` writes a `<method>.folded` file of
+    collapsed stacks for each method, the input of flamegraph.pl and
+    speedscope.
+    """
+
+    def __init__(self, rate=0.01, interval=0.001):
+        super(SamplingProfiler, self).__init__(rate)
+        self.interval = interval
+        self._stacks = {} # method name -> {collapsed stack: samples}
+
+    def profile(self, method_name, func, *args, **kwargs):
+        sampler = _StackSampler(get_ident(), self.interval)
+        sampler.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            sampler.stop()
+            self._lock.acquire()
+            try:
+                stacks = self._stacks.setdefault(method_name, {})
+                for stack, count in sampler.stacks.iteritems():
+                    stacks[stack] = stacks.get(stack, 0) + count
+            finally:
+                self._lock.release()
+
+    def collapsed(self, method_name):
+        "The collapsed stacks of `method_name`, one `frame;frame count` per line"
+        self._lock.acquire()
+        try:
+            stacks = sorted(self._stacks.get(method_name, {}).items())
+        finally:
+            self._lock.release()
+        return ''.join(['%s %d\n' % item for item in stacks])
+
+    def methods(self):
+        return sorted(self._stacks)
+
+    def dump(self, directory):
+        for method_name in self.methods():
+            f = open(os.path.join(directory, self.filename(method_name, '.folded')), 'w')
+            try:
+                f.write(self.collapsed(method_name))
+            finally:
+                f.close()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._stacks.clear()
+        finally:
+            self._lock.release()
+
+
+class _StackSampler(Thread):
+    """ Counts the stacks thread `thread_id` is seen in until stopped """
+
+    def __init__(self, thread_id, interval):
+        super(_StackSampler, self).__init__()
+        self.daemon = True
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._stopped = Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = collapse_stack(frame)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def collapse_stack(frame):
+    """ The stack of `frame` as `outermost;...;innermost` function names """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%d)' % (code.co_name,
+                                     os.path.basename(code.co_filename),
+                                     code.co_firstlineno))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
@@ -1,45 +1,479 @@
+import sys
+import time
+import logging
 import uuid
-from django.test.client import Client
-from jsonrpc._json import loads, dumps
+import socket
+import httplib
+import threading
+from contextlib import contextmanager
+from select import select
+from urlparse import urlsplit
+from Queue import LifoQueue, Empty, Full
+from multiprocessing.pool import ThreadPool
+from jsonrpc._json import get_codec, media_type
+from jsonrpc.compression import encodings, preference
 from jsonrpc.types import Any, Object
 
 
-class JsonRpcTestClient(Client):
-    def store_exc_info(self, **kwargs):
-        # Do not store view exceptions. Let the site object handle them.
-        pass
+logger = logging.getLogger(__name__)
 
 
-class TestServiceProxy(object):
-    def __init__(self, service_url, service_name=None, version='1.0'):
+class TimeoutError(Exception):
+    "Raised when the response of a call isn't there in time"
+
+
+class CallFuture(object):
+    """
+    The response of a call that is sent in a batch or in the background.
+    With a `timeout`, waiting for the response gives up that many seconds
+    after the call was made.
+    """
+
+    def __init__(self, timeout=None):
+        self._done = threading.Event()
+        self._response = None
+        self._exc_info = None
+        self._deadline = time.time() + timeout if timeout is not None else None
+
+    def done(self):
+        return self._done.isSet()
+
+    def result(self, timeout=None):
+        "Waits up to `timeout` seconds for the response and returns it"
+        if timeout is None and self._deadline is not None:
+            timeout = max(0, self._deadline - time.time())
+        if not self._done.wait(timeout):
+            raise TimeoutError('No response within %s seconds' % timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._response
+
+    def set_result(self, response):
+        self._response = response
+        self._done.set()
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._done.set()
+
+
+def gather(futures, timeout=None):
+    """
+    Returns the responses of `futures` in order, waiting up to `timeout`
+    seconds for all of them.
+    """
+    deadline = time.time() + timeout if timeout is not None else None
+    return [future.result(None if deadline is None else max(0, deadline - time.time()))
+            for future in futures]
+
+
+class BaseServiceProxy(object):
+    """
+    Calls the methods of a JSON-RPC service as attributes of the proxy, ie.
+    `proxy.myapp.sayHello('Sam')` calls "myapp.sayHello", and returns the
+    response. Subclasses send the requests in `_send`.
+
+    Calls made within `with proxy.batch():` are sent together when the
+    block ends, see `batch`. Requests and responses are serialized with
+    `codec`, the name of a registered codec or a `Codec`, which must be
+    one the service accepts.
+    """
+
+    def __init__(self, service_url, service_name=None, version='1.0', codec='json'):
+        self.codec = get_codec(codec)
         self.__version = str(version)
         self.__service_url = service_url
         self.__service_name = service_name
-        self.client = JsonRpcTestClient()
+        self.__local = threading.local() # the batch being collected
+        self._batcher = None
 
     def __getattr__(self, name):
         if self.__service_name != None:
             name = "%s.%s" % (self.__service_name, name)
-        return TestServiceProxy(self.__service_url, name, self.__version)
+        return self._proxy(name)
 
-    def __call__(self, *args, **kwargs):
+    def _proxy(self, service_name):
+        "A proxy of `service_name` sharing everything else with this one"
+        proxy = object.__new__(self.__class__)
+        proxy.__dict__.update(self.__dict__)
+        proxy.__service_name = service_name
+        return proxy
+
+    def _request(self, args, kwargs, version=None):
+        "The request calling the method of this proxy"
+        version = version or self.__version
         params = kwargs if len(kwargs) else args
-        if Any.kind(params) == Object and self.__version != '2.0':
+        if Any.kind(params) == Object and version != '2.0':
             raise ValueError('Unsupported arg type for JSON-RPC 1.0 ' \
                              '(the default version for this client, ' \
                              'pass version="2.0" to use keyword arguments)')
-        response = self.client.post(self.__service_url, dumps({
-                                "jsonrpc": self.__version,
-                                "method": self.__service_name,
-                                'params': params,
-                                'id': str(uuid.uuid1()),
-        }), content_type="application/json-rpc")
-        y = loads(response.content)
+        return {
+            "jsonrpc": version,
+            "method": self.__service_name,
+            'params': params,
+            'id': str(uuid.uuid1()),
+        }
+
+    def _send(self, request, retry=None):
+        """
+        Posts the serialized `request` to the service and returns the
+        response body. `retry` tells whether the request is safe to send
+        again, None if it depends on the method of this proxy.
+        """
+        raise NotImplementedError
+
+    def _retry(self, requests):
+        "Whether `requests` are safe to send again"
+        return False
+
+    def __call__(self, *args, **kwargs):
+        batch = getattr(self.__local, 'batch', None)
+        if batch is not None:
+            future = CallFuture()
+            batch.append((self._request(args, kwargs, '2.0'), future))
+            return future
+        if self._batcher is not None:
+            return self._batcher.submit(self._request(args, kwargs, '2.0')).result()
+        return self._call(self._request(args, kwargs))
+
+    def _batching(self):
+        "Whether calls in the current thread are collected by `batch`"
+        return getattr(self.__local, 'batch', None) is not None
+
+    def _call(self, request):
+        "Sends `request` on its own and returns the response"
+        y = self.codec.loads(self._send(self.codec.dumps(request)))
         if y.get("error", None):
+            logger.debug('%s error %r', self.__service_name, y)
+        return y
+
+    @contextmanager
+    def batch(self):
+        """
+        Collects the calls made through this proxy, and the proxies of its
+        methods, in the current thread and sends them in one JSON-RPC 2.0
+        batch request when the block ends. Calls return a `CallFuture` of
+        their response. Calls in a nested block join the outer batch. If
+        the block raises, nothing is sent.
+        """
+        if getattr(self.__local, 'batch', None) is not None:
+            yield self
+            return
+        entries = self.__local.batch = []
+        try:
+            yield self
+        except:
+            exc_info = sys.exc_info()
+            for request, future in entries:
+                future.set_exception(exc_info)
+            raise
+        finally:
+            self.__local.batch = None
+        self._send_batch(entries)
+
+    def _send_batch(self, entries):
+        "Sends (request, `CallFuture`) pairs in one request and resolves the futures"
+        if not entries:
+            return
+        try:
+            requests = [request for request, future in entries]
+            responses = self.codec.loads(self._send(self.codec.dumps(requests),
+                                                    retry=self._retry(requests)))
+        except:
+            exc_info = sys.exc_info()
+            for request, future in entries:
+                future.set_exception(exc_info)
+            return
+        if type(responses) is not list: # the whole batch failed
+            responses = [responses] * len(entries)
+        futures = dict([(request['id'], future) for request, future in entries])
+        unmatched = []
+        for response in responses:
+            future = None
+            if type(response) is dict and type(response.get('id')) in (str, unicode):
+                future = futures.pop(response['id'], None)
+            if future is None:
+                unmatched.append(response)
+            else:
+                future.set_result(response)
+        # entries that failed may come back without their id, in order
+        unanswered = [future for request, future in entries if request['id'] in futures]
+        for future, response in zip(unanswered, unmatched):
+            future.set_result(response)
+        for future in unanswered[len(unmatched):]:
             try:
-                from django.conf import settings
-                if settings.DEBUG:
-                    print '%s error %r' % (self.__service_name, y)
-            except:
-                pass
-        return y
\ No newline at end of file
+                raise ValueError('The batch response lacks the response to a call')
+            except ValueError:
+                future.set_exception(sys.exc_info())
+
+    @property
+    def _service_url(self):
+        return self.__service_url
+
+    @property
+    def _service_name(self):
+        return self.__service_name
+
+
+class TestServiceProxy(BaseServiceProxy):
+    "Calls a service of this Django project through the test `Client`"
+
+    def __init__(self, service_url, service_name=None, version='1.0', codec='json'):
+        super(TestServiceProxy, self).__init__(service_url, service_name, version, codec)
+        from jsonrpc.testclient import JsonRpcTestClient
+        self.client = JsonRpcTestClient()
+
+    def _proxy(self, service_name):
+        proxy = super(TestServiceProxy, self)._proxy(service_name)
+        from jsonrpc.testclient import JsonRpcTestClient
+        proxy.client = JsonRpcTestClient()
+        return proxy
+
+    def _send(self, request, retry=None):
+        return self.client.post(self._service_url, request,
+                                content_type=self.codec.content_type,
+                                HTTP_ACCEPT=self.codec.content_type).content
+
+
+class ConnectionPool(object):
+    """
+    Keeps up to `pool_size` idle keep-alive connections to the host of
+    `url`. More connections are opened while that many are in use, the
+    ones that don't fit in the pool when they are released are closed.
+    The connection used last is reused first, and connections the server
+    closed meanwhile are discarded.
+    """
+
+    def __init__(self, url, pool_size=4, timeout=30):
+        parts = urlsplit(url)
+        if parts.scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        elif parts.scheme == 'http':
+            self.connection_class = httplib.HTTPConnection
+        else:
+            raise ValueError('Unsupported URL scheme %r' % parts.scheme)
+        self.host = parts.netloc
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+        self.timeout = timeout
+        self._idle = LifoQueue(pool_size)
+
+    def get(self):
+        "An idle connection, or a new one"
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except Empty:
+                return self.connection_class(self.host, timeout=self.timeout)
+            if not self._closed(connection):
+                return connection
+            connection.close()
+
+    def put(self, connection):
+        "Releases a connection that is done with its last response"
+        try:
+            self._idle.put_nowait(connection)
+        except Full:
+            connection.close()
+
+    def _closed(self, connection):
+        # an idle connection that is readable was closed by the server
+        return connection.sock is None or bool(select([connection.sock], [], [], 0)[0])
+
+    def close(self):
+        "Closes all idle connections"
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                return
+
+
+class ServiceProxy(BaseServiceProxy):
+    """
+    Calls a JSON-RPC service over HTTP, keeping connections alive between
+    calls in a `ConnectionPool` shared by the proxies of all its methods.
+    Proxies are thread-safe.
+
+      pool_size     the number of idle connections kept open
+      timeout       seconds to wait for connecting and for each response
+      retries       how often to retry calls of `idempotent` methods that
+                    fail because of the connection
+      idempotent    the names of the methods that are safe to call twice,
+                    others are never retried
+      headers       extra HTTP headers sent with every request
+      compress_min_size  if given, request bodies at least this long are
+                    sent gzipped, responses are accepted compressed with
+                    any of the available encodings anyway
+      batch_window  if given, calls made by any thread within this many
+                    seconds of each other are sent in one batch request,
+                    of at most `max_batch` calls
+      codec         the codec of requests and responses, ie. 'msgpack'
+                    for a service whose site accepts it
+    """
+
+    def __init__(self, service_url, service_name=None, version='1.0',
+                 pool_size=4, timeout=30, retries=2, idempotent=(),
+                 headers=None, compress_min_size=None, batch_window=None,
+                 max_batch=100, codec='json'):
+        super(ServiceProxy, self).__init__(service_url, service_name, version, codec)
+        self.pool = ConnectionPool(service_url, pool_size, timeout)
+        self.retries = retries
+        self.idempotent = frozenset(idempotent)
+        accept = self.codec.content_type
+        if accept == 'application/json-rpc':
+            accept += ', application/json'
+        self.headers = {'Content-Type': self.codec.content_type,
+                        'Accept': accept,
+                        'Accept-Encoding': ', '.join(preference)}
+        self.headers.update(headers or {})
+        self.compress_min_size = compress_min_size
+        if batch_window is not None:
+            self._batcher = AutoBatcher(self._send_batch, batch_window, max_batch)
+
+    def _retry(self, requests):
+        return all([request['method'] in self.idempotent for request in requests])
+
+    def _send(self, request, retry=None):
+        if retry is None:
+            retry = self._service_name in self.idempotent
+        attempts = 1 + (self.retries if retry else 0)
+        headers = self.headers
+        if self.compress_min_size is not None and len(request) >= self.compress_min_size:
+            request = encodings['gzip'].compress(request)
+            headers = dict(headers, **{'Content-Encoding': 'gzip'})
+        while True:
+            attempts -= 1
+            connection = self.pool.get()
+            try:
+                connection.request('POST', self.pool.path, request, headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                if attempts > 0:
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self.pool.put(connection)
+            encoding = (response.getheader('Content-Encoding') or '').strip().lower()
+            if encoding and encoding != 'identity':
+                if encoding not in encodings:
+                    raise httplib.HTTPException('Unsupported content encoding %r' % encoding)
+                body = encodings[encoding].decompress(body)
+            content_type = media_type(response.getheader('Content-Type') or '')
+            if response.status >= 400 and content_type != self.codec.content_type \
+                    and not body.lstrip().startswith(('{', '[')):
+                raise httplib.HTTPException('%s %s: %s' % (response.status,
+                                                           response.reason,
+                                                           body[:200]))
+            return body
+
+    def close(self):
+        "Closes the idle connections of the pool"
+        self.pool.close()
+
+
+class AutoBatcher(object):
+    """
+    Coalesces the calls submitted within `window` seconds of the first one
+    into a batch, sent by `send_batch` from a timer thread, or right away
+    once it holds `max_batch` calls. `timeout` is passed to the futures of
+    the calls.
+    """
+
+    def __init__(self, send_batch, window, max_batch=100, timeout=None):
+        self.send_batch = send_batch
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def submit(self, request):
+        "Adds `request` to the next batch and returns the `CallFuture` of its response"
+        future = CallFuture(self.timeout)
+        self._lock.acquire()
+        try:
+            self._pending.append((request, future))
+            if len(self._pending) >= self.max_batch:
+                entries, self._pending = self._pending, []
+            else:
+                entries = None
+                if len(self._pending) == 1:
+                    timer = threading.Timer(self.window, self.flush)
+                    timer.daemon = True
+                    timer.start()
+        finally:
+            self._lock.release()
+        if entries:
+            self.send_batch(entries)
+        return future
+
+    def flush(self):
+        "Sends the calls submitted so far"
+        self._lock.acquire()
+        try:
+            entries, self._pending = self._pending, []
+        finally:
+            self._lock.release()
+        self.send_batch(entries)
+
+
+class AsyncServiceProxy(ServiceProxy):
+    """
+    A `ServiceProxy` whose calls return a `CallFuture` right away and run
+    in the background, so that calls to many services can be in flight at
+    once. There is no asyncio on Python 2, the calls run in a pool of
+    threads sharing the connection pool.
+
+      max_concurrency   the number of calls in flight at once, later calls
+                        wait for a free thread
+      call_timeout      seconds after which waiting for the response of a
+                        call raises a `TimeoutError`, the call itself can't
+                        be stopped and still completes in the background
+      batch_window      if given, calls made within this many seconds of
+                        each other are sent in one batch request
+
+    The other arguments are those of `ServiceProxy`, `pool_size` defaults
+    to `max_concurrency`.
+    """
+
+    def __init__(self, service_url, service_name=None, version='1.0',
+                 max_concurrency=10, call_timeout=None, batch_window=None,
+                 max_batch=100, **kwargs):
+        kwargs.setdefault('pool_size', max_concurrency)
+        super(AsyncServiceProxy, self).__init__(service_url, service_name,
+                                                version, **kwargs)
+        self.call_timeout = call_timeout
+        self.workers = ThreadPool(max_concurrency)
+        if batch_window is not None:
+            self._batcher = AutoBatcher(self._submit_batch, batch_window,
+                                        max_batch, call_timeout)
+
+    def __call__(self, *args, **kwargs):
+        if self._batching():
+            return super(AsyncServiceProxy, self).__call__(*args, **kwargs)
+        if self._batcher is not None:
+            return self._batcher.submit(self._request(args, kwargs, '2.0'))
+        future = CallFuture(self.call_timeout)
+        self.workers.apply_async(_resolve, (future, self._call, self._request(args, kwargs)))
+        return future
+
+    def _submit_batch(self, entries):
+        self.workers.apply_async(self._send_batch, (entries,))
+
+    def close(self):
+        "Stops the threads once the calls in flight are done and closes the idle connections"
+        self.workers.close()
+        super(AsyncServiceProxy, self).close()
+
+
+def _resolve(future, func, *args):
+    try:
+        future.set_result(func(*args))
+    except:
+        future.set_exception(sys.exc_info())
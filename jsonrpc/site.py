@@ -1,13 +1,36 @@
-from uuid import uuid1
+import sys
+from copy import copy, deepcopy
+from functools import partial
+from cStringIO import StringIO
+from uuid import uuid1, uuid4
+from hashlib import md5
 import re
-from inspect import getargspec
+from inspect import getargspec, isgenerator
+from collections import namedtuple
+from threading import Event
 from django.core import signals
-from django.http import HttpResponse
-from django.shortcuts import render_to_response
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified, Http404
+try:
+    from django.http import StreamingHttpResponse
+except ImportError: # Django < 1.5 streams responses built from iterators
+    StreamingHttpResponse = HttpResponse
+# whether request_finished, which closes the database connections, fires
+# before the response is iterated
+EARLY_REQUEST_FINISHED = StreamingHttpResponse is HttpResponse
+from django.template.loader import render_to_string
 from django.template.context import RequestContext
 from django.utils.datastructures import SortedDict
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
 from django.contrib.auth import authenticate
-from jsonrpc._json import loads, dumps
+from jsonrpc.auth import AuthenticationContext
+from jsonrpc.cache import result_key
+from jsonrpc.executors import TimeoutExecutor, close_connections
+from jsonrpc.metrics import CallTimer
+from jsonrpc.compression import encodings, negotiate, decompressing_reader
+from jsonrpc._json import loads, dumps, get_codec, fallback_default, iter_array, media_type, \
+     encodes_by_default, EncoderCodec
 from jsonrpc.exceptions import *
 from jsonrpc.types import *
 import app_settings
@@ -58,6 +81,126 @@ def _eval_arg_type(arg_type, T=Any, arg=None, sig=None):
         return T
 
 
+class CallPlan(namedtuple("CallPlan", "func binder validators")):
+    """
+    An immutable, precompiled description of how to invoke an `RpcMethod`.
+
+      func          the method wrapped by all of its decorators
+      binder        the `Binder` of the params of a call to its arguments
+      validators    (argument name, compiled type) pairs, see
+                    `jsonrpc.types.compile_validators`
+    """
+    __slots__ = ()
+
+
+class EncodedResult(object):
+    """
+    A result serialized ahead of time, so that responses carrying it don't
+    serialize it again, see `JsonRpcSite.encode_response`. It is serialized
+    once per codec. `value` is a copy, the value itself never changes.
+    """
+    __slots__ = ('_value', '_encoded')
+
+    def __init__(self, value):
+        self._value = value
+        self._encoded = {} # codec -> serialized value
+
+    @property
+    def value(self):
+        return deepcopy(self._value)
+
+    def encode(self, codec, default=None):
+        try:
+            return self._encoded[codec]
+        except KeyError:
+            data = self._encoded[codec] = codec.dumps(self._value, default)
+            return data
+
+
+# stands in for an `EncodedResult` in the response it is spliced into
+_ENCODED_RESULT = u'jsonrpc:encoded-result:%s' % uuid4().hex
+
+
+def dumps_encoded(codec, response, default):
+    "Serializes `response`, whose result is an `EncodedResult`, with `codec`"
+    envelope = codec.dumps(dict(response, result=_ENCODED_RESULT), default)
+    return envelope.replace(codec.dumps(_ENCODED_RESULT),
+                            response['result'].encode(codec, default), 1)
+
+
+class ServiceDescription(namedtuple("ServiceDescription", "result etag pages")):
+    """
+    The description of a site as of the methods registered so far.
+
+      result        the description as an `EncodedResult`
+      etag          a digest of the description serialized by the site's codec
+      pages         rendered pages of the description, by template name
+    """
+    __slots__ = ()
+
+
+class Binder(object):
+    """
+    Checks the params of a call against the signature of a method and binds
+    them to its arguments in one pass, compiled once per method.
+
+      names         the argument names, in order
+      checks        the compiled type of each argument, see `compile_type`
+      required      the number of arguments without a default
+      positional    the number of leading arguments the method takes by
+                    position, params naming them are passed by position
+      signature     the signature quoted in error messages
+    """
+    __slots__ = ('names', 'checks', 'required', 'positional', 'signature')
+
+    def __init__(self, names, checks, required, positional, signature):
+        self.names = names
+        self.checks = checks
+        self.required = required
+        self.positional = positional
+        self.signature = signature
+
+    def __call__(self, args, kwargs):
+        """
+        Returns the positional and keyword arguments to call the method
+        with, or raises an `InvalidParamsError` if the params don't fit.
+        """
+        names, checks = self.names, self.checks
+        nargs = len(args)
+        if nargs + len(kwargs) < self.required:
+            raise InvalidParamsError('Not enough params provided for %s' % self.signature)
+        elif nargs + len(kwargs) > len(names):
+            raise InvalidParamsError('Too many params provided for %s' % self.signature)
+        for idx in xrange(nargs):
+            if kwargs and names[idx] in kwargs:
+                raise InvalidParamsError("Ambiguous argument \"%s\"" % names[idx])
+            check = checks[idx]
+            if check is not None and (type(args[idx]) in check[0]) is not check[1]:
+                raise InvalidParamsError('%s is not the correct type %s for %s' % (type(args[idx]), names[idx], self.signature))
+        if not kwargs: # enough positional params, nothing missing
+            return args, kwargs
+        for idx in xrange(nargs, len(names)):
+            name = names[idx]
+            if name not in kwargs:
+                if idx < self.required:
+                    raise InvalidParamsError("Missing argument \"%s\"" % name)
+                continue
+            check = checks[idx]
+            if check is not None and (type(kwargs[name]) in check[0]) is not check[1]:
+                raise InvalidParamsError('%s is not the correct type %s for %s' % (type(kwargs[name]), name, self.signature))
+        # pass named params by position as far as the method takes them so
+        idx = nargs
+        while idx < self.positional and names[idx] in kwargs:
+            idx += 1
+        if idx == nargs:
+            return args, kwargs
+        taken = names[nargs:idx]
+        bound = list(args) + [kwargs[name] for name in taken]
+        if len(taken) == len(kwargs):
+            return bound, {}
+        return bound, dict([(k, v) for k, v in kwargs.iteritems() if k not in taken])
+
+
 class RpcMethod(object):
     def __init__(self,
                  func,
@@ -65,7 +208,20 @@ class RpcMethod(object):
                  public=False,
                  idempotent=False,
                  decorators=None,
+                 concurrent=True,
+                 max_age=None,
+                 vary=None,
+                 etag=None,
+                 cache_timeout=None,
+                 timeout=None,
                  **kwargs):
+        if cache_timeout and not idempotent:
+            raise ValueError("Only the results of idempotent methods can be "
+                             "cached, %s is not idempotent" % repr(signature))
+        if timeout and not concurrent:
+            raise ValueError("Methods registered with concurrent=False run in "
+                             "the request's thread and can't have a timeout, "
+                             "%s has one" % repr(signature))
         self.func = func
         self.__doc__ = func.__doc__
         self.__signature_data = self.parse_signature(func, signature)
@@ -73,12 +229,31 @@ class RpcMethod(object):
         self.public = public
         self.idempotent = idempotent
         self.decorators = decorators or []
+        self.concurrent = concurrent
+        # HTTP caching of idempotent methods called by GET, `etag` is either
+        # True to tag responses with a digest of their content or a function
+        # taking the request and params of the call and returning a tag
+        self.max_age = max_age
+        self.vary = vary or []
+        self.etag = etag
+        # seconds to keep results in the site's `result_cache`
+        self.cache_timeout = cache_timeout
+        # seconds a call may take, True for the site's `timeout`, None or 0
+        # for no limit, methods that aren't `concurrent` have none
+        self.timeout = timeout
+        self._prepended = []
+        self._plan = None
+
+    @staticmethod
+    def argument_names(func):
+        "The names of the arguments `func` takes after the request"
+        bound_method = getattr(func, "__self__", None) is not None
+        return getargspec(func).args[2 if bound_method else 1:]
 
     @classmethod
     def parse_signature(cls, func, signature):
-        bound_method = getattr(func, "__self__", None) is not None
         argspec = getargspec(func)
-        argument_names = argspec.args[2 if bound_method else 1:]
+        argument_names = cls.argument_names(func)
         arguments = SortedDict([(arg, Any) for arg in argument_names])
         seen_positional_arguments = False
         m = SIGNATURE_RE.match(signature)
@@ -127,45 +302,101 @@ class RpcMethod(object):
 
     def prepend_argument(self, argument_name, argument_type=Any):
         self.__signature_data["arguments"].insert(0, argument_name, argument_type)
+        self._prepended.insert(0, argument_name)
+        self._plan = None
 
-    def __call__(self, request, *args, **kwargs):
+    def compile(self):
+        """
+        Builds the call plan for this method. `JsonRpcSite.register` calls
+        this once so that requests don't pay for wrapping `func` in its
+        decorators or walking the signature again.
+        """
         decorated = self.func
         for decorator in self.decorators:
             decorated = decorator(decorated)
-        return decorated(request, *args, **kwargs)
+        arguments = self.__signature_data["arguments"]
+        names = tuple(arguments.keys())
+        validators = compile_validators(arguments)
+        # the leading arguments the decorated method takes by position, after
+        # the ones prepended for `__call__` to consume. A wrapper that only
+        # takes `**kwargs` (or isn't a function) gets named params by name.
+        try:
+            taken = self.argument_names(decorated)
+        except TypeError:
+            taken = []
+        positional = 0
+        for name, expected in zip(names, self._prepended + taken):
+            if name != expected:
+                break
+            positional += 1
+        binder = Binder(names,
+                        tuple([check for name, check in validators]),
+                        len(names) - len(self.__signature_data["defaults"]),
+                        positional,
+                        self.signature)
+        self._plan = CallPlan(decorated, binder, validators)
+        return self._plan
+
+    @property
+    def plan(self):
+        return self._plan or self.compile()
+
+    def authorize(self, request, args, kwargs):
+        """
+        Checks the prepended arguments of a call, like credentials, and
+        returns the params left for `func`.
+        """
+        return args, kwargs
+
+    def call_authorized(self, request, *args, **kwargs):
+        "Calls `func` with params `authorize` has checked already"
+        return self.plan.func(request, *args, **kwargs)
+
+    def __call__(self, request, *args, **kwargs):
+        args, kwargs = self.authorize(request, args, kwargs)
+        return self.plan.func(request, *args, **kwargs)
 
 
 class AuthenticatedRpcMethod(RpcMethod):
     def __init__(self, *args, **kwargs):
+        self.authenticator = kwargs.pop("authenticator", None) or authenticate
         super(AuthenticatedRpcMethod, self).__init__(*args, **kwargs)
         if not self.public:
+            if self.cache_timeout:
+                raise ValueError("The results of authenticated methods can't "
+                                 "be cached, %s is not public" % repr(self.__name__))
             self.prepend_argument("password", String)
             self.prepend_argument("username", String)
 
-    def __call__(self, request, *args, **kwargs):
+    def authorize(self, request, args, kwargs):
         if self.public:
-            return super(AuthenticatedRpcMethod, self).__call__(request,
-                                                                *args,
-                                                                **kwargs)
-        user = None
+            return args, kwargs
         try:
             username, password = args[:2]
-            user = authenticate(username=username, password=password)
-            if user is not None:
-                args = args[2:]
         except ValueError:
             if "username" in kwargs and "password" in kwargs:
-                user = authenticate(username=kwargs["username"],
-                                    password=kwargs["password"])
-                if user is not None:
-                    kwargs.pop("username")
-                    kwargs.pop("password")
-                else:
-                    raise InvalidParamsError("Authenticated methods require at least [username, password] or {username: password:} arguments")
-            if user is None:
-                raise InvalidCredentialsError
+                kwargs = dict(kwargs) # may be the params of the request
+                username = kwargs.pop("username")
+                password = kwargs.pop("password")
+            else:
+                raise InvalidParamsError("Authenticated methods require at least [username, password] or {username: password:} arguments")
+        else:
+            args = args[2:]
+        user = self.authenticate(request, username, password)
+        if user is None:
+            raise InvalidCredentialsError
         request.user = user
-        return super(AuthenticatedRpcMethod, self).__call__(request, *args, **kwargs)
+        return args, kwargs
+
+    def authenticate(self, request, username, password):
+        """
+        Verifies the credentials with `authenticator`, only once per HTTP
+        request when `dispatch` set up an `AuthenticationContext`.
+        """
+        context = getattr(request, "jsonrpc_auth_context", None)
+        if context is not None:
+            return context.authenticate(self.authenticator, username, password)
+        return self.authenticator(username=username, password=password)
 
 
 def encode_kw11(p):
@@ -203,35 +434,224 @@ def encode_arg11(p):
         return [d[str(i)] for i in pos]
 
 
-def validate_params(method, *args, **kwargs):
-    keys = method.signature_data["arguments"].keys()
-    defaults = method.signature_data["defaults"]
-    if len(args) + len(kwargs) < len(keys) - len(defaults):
-        raise InvalidParamsError('Not enough params provided for %s' % method.signature)
-    elif len(args) + len(kwargs) > len(keys):
-        raise InvalidParamsError('Too many params provided for %s' % method.signature)
-    for idx, argument in enumerate(method.signature_data["arguments"].items()):
-        if idx < len(args):
-            if argument[0] in kwargs:
-                raise InvalidParamsError("Ambiguous argument \"%s\"" % argument[0])
-            if not Any.kind(args[idx]) == argument[1]:
-                raise InvalidParamsError('%s is not the correct type %s for %s' % (type(args[idx]), argument[0], method.signature))
+# Python accepts unicode keyword argument names from 2.6.5 on, so the params
+# of a call by name can be passed on as they were parsed
+UNICODE_KWARGS = sys.version_info >= (2, 6, 5)
+
+
+def normalize_params10(p):
+    return p, {}
+
+
+def normalize_params11(p):
+    """
+    Splits 1.1 params into positional arguments, given as a list or by
+    their index in an object, and keyword arguments. It does in one pass
+    what `encode_arg11` and `encode_kw11` do.
+    """
+    if type(p) is list:
+        return p, {}
+    elif not type(p) is dict:
+        return [], {}
+    positions = []
+    kwargs = {}
+    for k, v in p.iteritems():
+        try:
+            positions.append(int(k))
+        except ValueError:
+            kwargs[k if UNICODE_KWARGS else str(k)] = v
+    if not positions:
+        return [], kwargs
+    positions = list(set(positions))
+    positions.sort()
+    return [p[str(i)] for i in positions], kwargs
+
+
+def normalize_params20(p):
+    """ 2.0 params are either all positional or all named, never copied """
+    if type(p) is dict:
+        return (), p if UNICODE_KWARGS else encode_kw(p)
+    return p, {}
+
+
+# the params normalizer of each protocol version, returning the positional
+# and keyword arguments of a call
+PARAM_NORMALIZERS = {"1.0": normalize_params10,
+                     "1.1": normalize_params11,
+                     "2.0": normalize_params20}
+
+
+def _index_keys(name):
+    "The keys under which `suggest_methods` finds `name`: itself and all of its single character deletions"
+    name = name.lower()
+    return set([name] + [name[:i] + name[i + 1:] for i in xrange(len(name))])
+
+
+def _one_typo_apart(a, b):
+    """
+    Whether `a` and `b` are equal but for one inserted, deleted or replaced
+    character, or two adjacent characters swapped. Names that share an
+    `_index_keys` key can be two edits apart, ie. "bca" and "abc".
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    if len(a) - len(b) > 1:
+        return False
+    i = 0
+    while i < len(b) and a[i] == b[i]:
+        i += 1
+    if len(a) != len(b):
+        return a[i + 1:] == b[i:]
+    return a[i + 1:] == b[i + 1:] or (a[i:i + 2] == b[i + 1:i + 2] + b[i:i + 1] and a[i + 2:] == b[i + 2:])
+
+
+def in_transaction(chunks):
+    """
+    Yields `chunks` within a transaction of the default database, committed
+    once they are all yielded and rolled back if that fails, and closes the
+    database connections afterwards. Before Django 1.5 a streamed response
+    is iterated after the request is finished, when the request's
+    transaction is over and its connections closed.
+    """
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        try:
+            for chunk in chunks:
+                yield chunk
+        except:
+            transaction.rollback()
+            raise
         else:
-            if argument[0] not in kwargs and argument[0] not in defaults:
-                raise InvalidParamsError("Missing argument \"%s\"" % argument[0])
-            if argument[0] in kwargs and not Any.kind(kwargs[argument[0]]) == argument[1]:
-                raise InvalidParamsError('%s is not the correct type %s for %s' % (type(kwargs[argument[0]]), argument[0], method.signature))
+            if transaction.is_dirty():
+                transaction.commit()
+    finally:
+        transaction.leave_transaction_management()
+        close_connections()
+
+
+def etag_matches(request, etag):
+    "Whether the If-None-Match header of `request` matches `etag`"
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    etags = parse_etags(header)
+    return etag in etags or '*' in etags
+
+
+def validate_params(method, *args, **kwargs):
+    "Raises an `InvalidParamsError` if the params don't fit the signature of `method`"
+    method.plan.binder(args, kwargs)
+
+
+class _BodyReader(object):
+    """ Reads the body of a request without reading past its Content-Length """
+
+    def __init__(self, request):
+        self.stream = request.environ['wsgi.input']
+        try:
+            self.remaining = int(request.META.get('CONTENT_LENGTH', 0))
+        except (ValueError, TypeError):
+            self.remaining = 0
+
+    def read(self, size):
+        size = min(size, self.remaining)
+        if size <= 0:
+            return ''
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def request_reader(request):
+    """ Returns a `read(size)` function over the body of `request` """
+    if hasattr(request, '_raw_post_data'):
+        return StringIO(request._raw_post_data).read
+    if hasattr(request, 'read'): # Django >= 1.3
+        return request.read
+    return _BodyReader(request).read
+
+
+def parse_errors(entries):
+    """ Reports the entries `iter_array` fails to parse as a `ParseError` """
+    try:
+        for entry in entries:
+            yield entry
+    except ValueError, e:
+        raise ParseError(str(e))
 
 
 class JsonRpcSite(object):
     "A JSON-RPC Site"
-    def __init__(self, name, version="1.0", json_encoder=DjangoJSONEncoder):
+    def __init__(self,
+                 name,
+                 version="1.0",
+                 json_encoder=DjangoJSONEncoder,
+                 codec="json",
+                 batch_executor=None,
+                 stream_batches=False,
+                 stream_requests=False,
+                 auth_cache=None,
+                 result_cache=None,
+                 method_not_found="brief",
+                 timeout=None,
+                 timeout_executor=None,
+                 instrumentation=None,
+                 profiler=None,
+                 compress_min_size=None,
+                 alternative_codecs=()):
+        if method_not_found not in ("brief", "suggest", "list"):
+            raise ValueError('method_not_found must be one of "brief", '
+                             '"suggest" or "list", not %r' % method_not_found)
         self._urls = {}
+        self._method_index = {}
+        self.method_not_found = method_not_found
+        self.timeout = timeout
+        self.timeout_executor = timeout_executor or TimeoutExecutor()
+        self.instrumentation = instrumentation
+        self.profiler = profiler
+        self.compress_min_size = compress_min_size
+        self.auth_cache = auth_cache
+        self.result_cache = result_cache
         self.uuid = str(uuid1())
         self.version = version
         self.name = name
-        self.describe = self.register("system.describe", public=True)(self.describe)
+        self._description = None
+        self.describe = self.register("system.describe", public=True,
+                                      idempotent=True,
+                                      etag=self.describe_etag)(self.describe)
         self.json_encoder = json_encoder
+        self.codec = get_codec(codec)
+        self.alternative_codecs = [get_codec(c) for c in alternative_codecs]
+        self.batch_executor = batch_executor
+        self.stream_batches = stream_batches
+        self.stream_requests = stream_requests
+        self._json_defaults = {}
+        self._encoder_codecs = {}
+
+    def json_default(self, json_encoder):
+        "The `default` hook of `json_encoder` the codec falls back to"
+        try:
+            return self._json_defaults[json_encoder]
+        except KeyError:
+            default = self._json_defaults[json_encoder] = fallback_default(json_encoder)
+            return default
+
+    def encoder_codec(self, codec, json_encoder):
+        """
+        `codec`, or an `EncoderCodec` serializing with `json_encoder` itself
+        if `codec` is a JSON codec and the encoder customizes more than its
+        `default` method
+        """
+        try:
+            return self._encoder_codecs[codec, json_encoder]
+        except KeyError:
+            if codec.incremental and not encodes_by_default(json_encoder):
+                encoder_codec = EncoderCodec(codec, json_encoder)
+            else:
+                encoder_codec = codec
+            self._encoder_codecs[codec, json_encoder] = encoder_codec
+            return encoder_codec
 
     def register(self,
                  name,
@@ -240,6 +660,8 @@ class JsonRpcSite(object):
                  decorators=None,
                  **kwargs):
         decorators = decorators or []
+        if self.auth_cache is not None:
+            kwargs.setdefault("authenticator", self.auth_cache.authenticate)
         def decorator(method):
             rpc_method_class = kwargs.pop("rpc_class", AuthenticatedRpcMethod)
             rpc_method = rpc_method_class(method,
@@ -248,11 +670,78 @@ class JsonRpcSite(object):
                                           idempotent=idempotent,
                                           decorators=decorators,
                                           **kwargs)
+            rpc_method.compile()
             method_name = unicode(rpc_method.signature_data["method_name"])
             self._urls[method_name] = rpc_method
+            self._description = None
+            for key in _index_keys(method_name):
+                self._method_index.setdefault(key, set()).add(method_name)
             return method
         return decorator
 
+    def call_method(self, request, method, args, kwargs, profile_as=None):
+        """
+        Calls `method` with params its `authorize` has checked, within its
+        timeout in a thread of the `timeout_executor`, or else in the
+        request's thread. With `profile_as` a call with a timeout is
+        profiled in its thread as that method name.
+        """
+        timeout = self.method_timeout(method)
+        if timeout:
+            func = method.call_authorized
+            if profile_as is not None:
+                func = partial(self.profiler.profile, profile_as, func)
+            return self.timeout_executor.call(func, timeout, request, *args, **kwargs)
+        return method.call_authorized(request, *args, **kwargs)
+
+    def method_timeout(self, method):
+        "The seconds a call of `method` may take, None or 0 for no limit"
+        if method.timeout is True:
+            return self.timeout
+        return method.timeout
+
+    def invalidate_results(self, method=None, prefix=None):
+        """
+        Forgets the cached results of `method`, of all methods whose names
+        start with `prefix`, or of all methods.
+        """
+        names = [name for name, M in self._urls.items() if M.cache_timeout and
+                 (method is None or name == method) and
+                 (prefix is None or name.startswith(prefix))]
+        if self.result_cache is not None and names:
+            self.result_cache.invalidate(names)
+
+    def suggest_methods(self, name, limit=3):
+        """
+        Returns up to `limit` registered method names one typo away from
+        `name`, or that differ from it only in case.
+        """
+        if len(name) > 128:
+            return []
+        found = set()
+        for key in _index_keys(name):
+            found.update(self._method_index.get(key, ()))
+        name = name.lower()
+        return sorted([method_name for method_name in found
+                       if _one_typo_apart(name, method_name.lower())])[:limit]
+
+    def method_not_found_error(self, name):
+        """
+        The error for a call of the unknown method `name`. Depending on
+        `method_not_found` its message lists no other methods ("brief"), the
+        closest ones ("suggest") or all of them ("list").
+        """
+        if self.method_not_found == "list":
+            return MethodNotFoundError('Method not found. Available methods: %s' % (
+                                       '\n'.join(self._urls.keys())))
+        name = unicode(name)
+        message = 'Method "%s" not found.' % (name[:64] + (name[64:] and '...'))
+        if self.method_not_found == "suggest":
+            suggestions = self.suggest_methods(name)
+            if suggestions:
+                message += ' Did you mean: %s?' % ', '.join(suggestions)
+        return MethodNotFoundError(message)
+
     def empty_response(self, version='1.0'):
         response = {'id': None, 'error': None, 'result': None}
         if version == '1.1':
@@ -273,44 +762,71 @@ class JsonRpcSite(object):
           'version': '1.1'
         }
 
-    def response_dict(self, request, D, is_batch=False, version_hint='1.0', json_encoder=None):
+    def response_dict(self, request, D, is_batch=False, version_hint='1.0', json_encoder=None, timer=None):
+        if self.profiler is not None and self.profiler.sample():
+            try:
+                method = self._urls.get(D['method'])
+            except Exception:
+                method = None
+            method_name = method is not None and unicode(D['method']) or u'(unknown)'
+            if method is not None and self.method_timeout(method):
+                # the method runs in a thread of the `timeout_executor`, which
+                # `call_method` profiles instead of this one
+                return self._response_dict(request, D, is_batch, version_hint,
+                                           json_encoder, timer, method_name)
+            return self.profiler.profile(method_name, self._response_dict, request, D,
+                                         is_batch, version_hint, json_encoder, timer)
+        return self._response_dict(request, D, is_batch, version_hint, json_encoder, timer)
+
+    def _response_dict(self, request, D, is_batch, version_hint, json_encoder, timer, profile_as=None):
         json_encoder = json_encoder or self.json_encoder
         version = version_hint
         response = self.empty_response(version=version)
-        apply_version = {"2.0": lambda p: ([], encode_kw(p)) if type(p) is dict else (p, {}),
-                         "1.1": lambda p: (encode_arg11(p), encode_kw(encode_kw11(p))),
-                         "1.0": lambda p: (p, {})}
 
         try:
             if 'method' not in D or 'params' not in D:
                 raise InvalidParamsError('Request requires str:"method" and list:"params"')
             if D['method'] not in self._urls:
-                raise MethodNotFoundError('Method not found. Available methods: %s' % (
-                              '\n'.join(self._urls.keys())))
+                raise self.method_not_found_error(D['method'])
+            if timer is not None:
+                timer.method = unicode(D['method'])
+                self.instrumentation.start(request, timer.method)
 
             if 'jsonrpc' in D:
-                if str(D['jsonrpc']) not in apply_version:
+                if str(D['jsonrpc']) not in PARAM_NORMALIZERS:
                     raise InvalidRequestError('JSON-RPC version %s not supported.' % D['jsonrpc'])
                 version = request.jsonrpc_version = response['jsonrpc'] = str(D['jsonrpc'])
             elif 'version' in D:
-                if str(D['version']) not in apply_version:
+                if str(D['version']) not in PARAM_NORMALIZERS:
                     raise InvalidRequestError('JSON-RPC version %s not supported.' % D['version'])
                 version = request.jsonrpc_version = response['version'] = str(D['version'])
             else:
                 request.jsonrpc_version = '1.0'
 
             method = self._urls[str(D['method'])]
-            args, kwargs = apply_version[version](D["params"])
-            validate_params(method, *args, **kwargs)
-            R = method(request, *args, **kwargs)
-
-            encoder = json_encoder()
-            if not sum(map(lambda e: isinstance(R, e), # type of `R` should be one of these or...
-                      (dict, str, unicode, int, long, list, set, NoneType, bool))):
-                try:
-                    rs = encoder.default(R) # ...or something this thing supports
-                except TypeError, exc:
-                    raise TypeError("Return type not supported, for %r" % R)
+            args, kwargs = PARAM_NORMALIZERS[version](D["params"])
+            if timer is not None:
+                timer.mark('normalize')
+            args, kwargs = method.plan.binder(args, kwargs)
+            # credentials are checked before an `etag` validator may answer
+            args, kwargs = method.authorize(request, args, kwargs)
+            if timer is not None:
+                timer.mark('validate')
+            if callable(method.etag) and request.method == 'GET':
+                request.jsonrpc_etag = method.etag(request, *args, **kwargs)
+                if etag_matches(request, request.jsonrpc_etag):
+                    return None, 304
+            if method.cache_timeout and self.result_cache is not None:
+                R = self.result_cache.get_or_call(method.signature_data["method_name"],
+                                                  result_key(args, kwargs),
+                                                  lambda: self.call_method(request, method, args, kwargs, profile_as),
+                                                  method.cache_timeout)
+            else:
+                R = self.call_method(request, method, args, kwargs, profile_as)
+            if timer is not None:
+                timer.mark('execute')
+            # return types are checked when the response is serialized, see
+            # `encode_response`
 
             if 'id' in D and D['id'] is not None: # regular request
                 response['result'] = R
@@ -341,11 +857,175 @@ class JsonRpcSite(object):
 
         return response, status
 
+    def encode_response(self, request, response, default, codec=None):
+        """
+        Serializes a response dict made by `response_dict` with `codec`, the
+        site's by default. A result the codec can't serialize is replaced by
+        an `OtherError`.
+
+        Returns the serialized response and the error, if there was one.
+        """
+        codec = codec or self.codec
+        try:
+            if isinstance(response.get('result'), EncodedResult):
+                return dumps_encoded(codec, response, default), None
+            return codec.dumps(response, default), None
+        except Exception, e:
+            signals.got_request_exception.send(sender=self.__class__, request=request)
+            if isinstance(e, TypeError):
+                e = TypeError("Return type not supported, for %r" % response.get('result'))
+            other_error = OtherError(e)
+            response['error'] = other_error.json_rpc_format
+            if response.get('version') == '1.1':
+                response.pop('result', None)
+            else:
+                response['result'] = None
+            return codec.dumps(response, default), other_error
+
+    def encode_call(self, request, response, default, timer=None, codec=None):
+        """
+        Serializes a response like `encode_response` and, if `timer` is
+        given, reports the call to the `instrumentation`.
+        """
+        if timer is None:
+            return self.encode_response(request, response, default, codec)
+        timer.skip() # time waiting for the previous entries of a batch
+        json_rpc, error = self.encode_response(request, response, default, codec)
+        timer.mark('serialize')
+        self.instrumentation.finish(request, timer, response)
+        return json_rpc, error
+
+    def batch_responses(self, request, batch, json_encoder=None):
+        """
+        Yields the response dict of each entry of `batch` and the `CallTimer`
+        of the entry, or None without `instrumentation`, in order. With a
+        `batch_executor` entries run concurrently, each with a copy of
+        `request`, except those calling methods registered with
+        `concurrent=False`.
+        """
+        timed = self.instrumentation is not None
+        if self.batch_executor is None:
+            for D in batch:
+                timer = timed and CallTimer() or None
+                yield self.response_dict(request, D, is_batch=True, json_encoder=json_encoder, timer=timer)[0], timer
+            return
+        def call(D):
+            timer = timed and CallTimer() or None
+            return self.response_dict(copy(request), D, is_batch=True, json_encoder=json_encoder, timer=timer)[0], timer
+        def inline(D):
+            try:
+                return not self._urls[D['method']].concurrent
+            except Exception: # invalid entries are answered in this thread
+                return True
+        for response in self.batch_executor.imap(call, batch, inline):
+            yield response
+
+    def stream_batch(self, request, batch, default, json_encoder=None, codec=None):
+        """
+        Yields the serialized response array of `batch` piece by piece, each
+        entry as soon as it is done, as far as `codec` can stream arrays.
+        """
+        codec = codec or self.codec
+        return codec.stream_array(self._stream_entries(request, batch, default,
+                                                       json_encoder, codec))
+
+    def _stream_entries(self, request, batch, default, json_encoder, codec):
+        if not EARLY_REQUEST_FINISHED:
+            return self._serialize_entries(request, batch, default, json_encoder, codec)
+        return in_transaction(self._serialize_entries(request, batch, default,
+                                                      json_encoder, codec))
+
+    def _serialize_entries(self, request, batch, default, json_encoder, codec):
+        try:
+            for response, timer in self.batch_responses(request, batch, json_encoder=json_encoder):
+                yield self.encode_call(request, response, default, timer, codec)[0]
+        except ParseError, e: # the rest of the batch is lost
+            signals.got_request_exception.send(sender=self.__class__, request=request)
+            response = self.empty_response(version='2.0')
+            response['error'] = e.json_rpc_format
+            yield codec.dumps(response, default)
+
+    def request_codec(self, request):
+        """
+        The codec the body of `request` is serialized with: the alternative
+        codec its Content-Type names, or the site's.
+        """
+        content_type = media_type(request.META.get('CONTENT_TYPE', ''))
+        for codec in self.alternative_codecs:
+            if content_type == codec.content_type or content_type in codec.content_types:
+                return codec
+        return self.codec
+
+    def response_codec(self, request, request_codec):
+        """
+        The codec to serialize the response to `request` with: the one its
+        Accept header prefers among the site's codecs, `request_codec` if
+        it names none of them.
+        """
+        if not self.alternative_codecs:
+            return self.codec
+        weights = {}
+        for item in request.META.get('HTTP_ACCEPT', '').split(','):
+            parts = item.split(';')
+            weight = 1.0
+            for param in parts[1:]:
+                key, _, value = param.partition('=')
+                if key.strip().lower() == 'q':
+                    try:
+                        weight = float(value)
+                    except ValueError:
+                        weight = 0.0
+            weights[media_type(parts[0])] = weight
+        best, best_weight = request_codec, 0.0
+        for codec in [request_codec, self.codec] + self.alternative_codecs:
+            content_types = (codec.content_type,) + tuple(codec.content_types)
+            if codec is self.codec:
+                content_types += ('application/json',)
+            weight = max([weights.get(t, 0.0) for t in content_types])
+            if weight > best_weight:
+                best, best_weight = codec, weight
+        return best
+
+    def read_request(self, request, chunk_size=64 * 1024, codec=None):
+        """
+        Parses the body of a POST request with `codec`, the site's by
+        default, decompressing it if it was sent with a Content-Encoding.
+        With `stream_requests` the entries of a batch are parsed while the
+        ones before them are being run, if the codec is incremental.
+        """
+        codec = codec or self.codec
+        encoding = request.META.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding == 'identity':
+            encoding = ''
+        stream = self.stream_requests and codec.incremental
+        if not stream and not encoding:
+            return codec.loads(request.raw_post_data)
+        read = request_reader(request)
+        if encoding:
+            read = decompressing_reader(read, encoding)
+        if not stream:
+            return codec.loads(''.join(iter(lambda: read(chunk_size), '')))
+        head = read(chunk_size)
+        while head.isspace():
+            chunk = read(chunk_size)
+            if not chunk:
+                break
+            head += chunk
+        if head.lstrip().startswith('['):
+            return parse_errors(iter_array(read, codec.loads, head, chunk_size))
+        return codec.loads(head + ''.join(iter(lambda: read(chunk_size), '')))
+
     @csrf_exempt
     def dispatch(self, request, method='', json_encoder=None):
         if request.method.lower() == "options":
             return self.preflight(request)
         json_encoder = json_encoder or self.json_encoder
+        default = self.json_default(json_encoder)
+        timer = self.instrumentation is not None and CallTimer() or None
+        # set on the copy of the request a call with a timeout gets
+        request.jsonrpc_cancelled = Event()
+        codec = self.request_codec(request)
+        response_codec = self.encoder_codec(self.response_codec(request, codec), json_encoder)
 
         try:
             # in case we do something json doesn't like, we always get back valid json-rpc response
@@ -356,24 +1036,59 @@ class JsonRpcSite(object):
                 raise RequestPostError
             else:
                 try:
-                    jsonrpc_request = loads(request.raw_post_data)
+                    jsonrpc_request = self.read_request(request, codec=codec)
                 except:
                     raise InvalidRequestError
 
-            if type(jsonrpc_request) is list:
-                response = [self.response_dict(request, d, is_batch=True, json_encoder=json_encoder)[0] for d in jsonrpc_request]
+            is_batch = type(jsonrpc_request) is list or isgenerator(jsonrpc_request)
+            if timer is not None:
+                timer.mark('parse')
+            if is_batch:
+                request.jsonrpc_auth_context = AuthenticationContext()
+                if timer is not None: # the entries of a batch are timed one by one
+                    timer.method = u'(batch)'
+                    self.instrumentation.finish(request, timer)
+                    timer = None
+            if is_batch and self.stream_batches:
+                chunks = self.stream_batch(request, jsonrpc_request, default,
+                                           json_encoder=json_encoder, codec=response_codec)
+                encoding = self.response_encoding(request)
+                if encoding is not None:
+                    chunks = encodings[encoding].compress_stream(chunks)
+                response = StreamingHttpResponse(chunks, status=200, content_type=response_codec.content_type)
+                response["Access-Control-Allow-Origin"] = "*"
+                if self.alternative_codecs:
+                    patch_vary_headers(response, ('Accept',))
+                if self.compress_min_size is not None:
+                    patch_vary_headers(response, ('Accept-Encoding',))
+                if encoding is not None:
+                    response['Content-Encoding'] = encoding
+                return response
+            elif is_batch:
+                json_rpc = response_codec.dumps_array([
+                    self.encode_call(request, r, default, t, response_codec)[0]
+                    for r, t in self.batch_responses(request, jsonrpc_request, json_encoder=json_encoder)])
                 status = 200
             else:
-                response, status = self.response_dict(request, jsonrpc_request, json_encoder=json_encoder)
+                response, status = self.response_dict(request, jsonrpc_request, json_encoder=json_encoder, timer=timer)
+                if response is None and timer is not None: # a notification or not modified
+                    self.instrumentation.finish(request, timer)
+                    timer = None
+                if status == 304:
+                    return self.http_cache(request, method, HttpResponseNotModified())
                 if response is None and (not u'id' in jsonrpc_request or jsonrpc_request[u'id'] is None): # a notification
                     return HttpResponse('', status=status)
-
-            json_rpc = dumps(response, cls=json_encoder)
+                json_rpc, error = self.encode_call(request, response, default, timer, response_codec)
+                timer = None
+                if error is not None:
+                    status = error.status
         except Error, e:
             signals.got_request_exception.send(sender=self.__class__, request=request)
             response['error'] = e.json_rpc_format
             status = e.status
-            json_rpc = dumps(response, cls=json_encoder)
+            json_rpc = response_codec.dumps(response, default)
+            if timer is not None:
+                self.instrumentation.finish(request, timer, response)
         except Exception, e:
             # exception missed by others
             signals.got_request_exception.send(sender=self.__class__, request=request)
@@ -382,9 +1097,68 @@ class JsonRpcSite(object):
             response['error'] = other_error.json_rpc_format
             status = other_error.status
 
-            json_rpc = dumps(response, cls=json_encoder)
+            json_rpc = response_codec.dumps(response, default)
+            if timer is not None:
+                self.instrumentation.finish(request, timer, response)
 
-        response = HttpResponse(json_rpc, status=status, content_type='application/json-rpc')
+        response = HttpResponse(json_rpc, status=status, content_type=response_codec.content_type)
+        response["Access-Control-Allow-Origin"] = "*"
+        if self.alternative_codecs:
+            patch_vary_headers(response, ('Accept',))
+        if request.method.lower() == 'get' and status == 200:
+            response = self.http_cache(request, method, response, json_rpc)
+        return self.compress_response(request, response)
+
+    def response_encoding(self, request):
+        "The encoding to compress the response to `request` with, or None"
+        if self.compress_min_size is None:
+            return None
+        return negotiate(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+
+    def compress_response(self, request, response):
+        """
+        Compresses the content of `response` with the encoding the client
+        prefers, if there is one and the content is at least
+        `compress_min_size` bytes long.
+        """
+        if self.compress_min_size is None:
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if (response.status_code == 304 or response.has_header('Content-Encoding') or
+                len(response.content) < self.compress_min_size):
+            return response
+        encoding = self.response_encoding(request)
+        if encoding is None:
+            return response
+        response.content = encodings[encoding].compress(response.content)
+        response['Content-Encoding'] = encoding
+        if response.has_header('ETag') and not response['ETag'].startswith('W/'):
+            # the tag is that of the uncompressed content
+            response['ETag'] = 'W/' + response['ETag']
+        return response
+
+    def http_cache(self, request, method, response, json_rpc=None):
+        """
+        Adds the HTTP caching headers `method` was registered with to the
+        response of a GET request, or returns a 304 response when the
+        client's copy is still current.
+        """
+        M = self._urls.get(unicode(method))
+        if M is None:
+            return response
+        etag = getattr(request, 'jsonrpc_etag', None)
+        if etag is None and M.etag is True and json_rpc is not None:
+            etag = md5(json_rpc).hexdigest()
+        if etag is not None:
+            if response.status_code == 200 and etag_matches(request, etag):
+                response = HttpResponseNotModified()
+            response['ETag'] = quote_etag(etag)
+        if M.max_age is not None:
+            patch_cache_control(response, max_age=M.max_age)
+        if isinstance(M, AuthenticatedRpcMethod) and not M.public:
+            patch_cache_control(response, private=True)
+        if M.vary:
+            patch_vary_headers(response, M.vary)
         response["Access-Control-Allow-Origin"] = "*"
         return response
 
@@ -399,24 +1173,58 @@ class JsonRpcSite(object):
             'return_type': str(M.signature_data["return_type"]),
         }
 
+    def _described(self):
+        "The `ServiceDescription` of the site, computed once until `register` is called again"
+        described = self._description
+        if described is None:
+            result = EncodedResult({
+                'sdversion': '1.0',
+                'name': self.name,
+                'id': 'urn:uuid:%s' % str(self.uuid),
+                'summary': self.__doc__,
+                'version': self.version,
+                'procs': map(self.procedure_desc, self._urls.iterkeys()),
+            })
+            json_rpc = result.encode(self.codec, self.json_default(self.json_encoder))
+            described = self._description = ServiceDescription(result, md5(json_rpc).hexdigest(), {})
+        return described
+
     def service_desc(self):
-        return {
-            'sdversion': '1.0',
-            'name': self.name,
-            'id': 'urn:uuid:%s' % str(self.uuid),
-            'summary': self.__doc__,
-            'version': self.version,
-            'procs': map(self.procedure_desc, self._urls.iterkeys()),
-        }
+        "The description of the site"
+        return self._described().result.value
 
     def describe(self, request):
         """Summarize service and the methods provided."""
-        return self.service_desc()
+        return self._described().result
+
+    def describe_etag(self, request):
+        return self._described().etag
 
     def documentation(self, request):
-        return render_to_response("jsonrpc/documentation/index.html",
-                                  {"service": self.service_desc()},
-                                  context_instance=RequestContext(request))
+        """
+        The description of the site as a page, rendered once per set of
+        methods, so the template mustn't depend on the request.
+        """
+        template_name = "jsonrpc/documentation/index.html"
+        described = self._described()
+        if etag_matches(request, described.etag):
+            response = HttpResponseNotModified()
+        else:
+            page = described.pages.get(template_name)
+            if page is None:
+                page = described.pages[template_name] = render_to_string(
+                    template_name, {"service": described.result.value},
+                    context_instance=RequestContext(request))
+            response = HttpResponse(page)
+        response['ETag'] = quote_etag(described.etag)
+        return response
+
+    def metrics(self, request):
+        "The metrics of the `instrumentation` in the Prometheus text format"
+        if self.instrumentation is None:
+            raise Http404
+        return HttpResponse(self.instrumentation.metrics.prometheus(),
+                            content_type='text/plain; version=0.0.4; charset=utf-8')
 
     def preflight(self, request):
         accepts = request.META.get("HTTP_ACCEPT", "")
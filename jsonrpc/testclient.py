@@ -0,0 +1,7 @@
+from django.test.client import Client
+
+
+class JsonRpcTestClient(Client):
+    def store_exc_info(self, **kwargs):
+        # Do not store view exceptions. Let the site object handle them.
+        pass
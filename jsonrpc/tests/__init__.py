@@ -1,20 +1,120 @@
+import zlib
+import random
+import socket
 import unittest
+import BaseHTTPServer
+import SocketServer
 import urllib
+import time
+import datetime
+import threading
+from decimal import Decimal
 from django.test import TestCase
+from django.db import transaction
 from django.utils import simplejson as json
+from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
+from django.core.cache import get_cache
+from django.core.handlers.wsgi import WSGIRequest
+from django.test.client import FakePayload
 from django.utils.datastructures import SortedDict
+from django.utils import translation
+from django.utils.translation import ugettext_lazy
+from jsonrpc._json import codecs, get_codec, iter_array, Codec
 from jsonrpc.conf import default_site
+from jsonrpc.executors import ThreadedExecutor, TimeoutExecutor
+from jsonrpc.auth import AuthenticationCache
+from jsonrpc.cache import LocMemResultCache, DjangoResultCache
+from jsonrpc.metrics import Instrumentation
+from jsonrpc.compression import encodings, negotiate, decompressing_reader
+from jsonrpc.profiling import CProfileProfiler, SamplingProfiler
+from jsonrpc.site import JsonRpcSite, EARLY_REQUEST_FINISHED
 from jsonrpc.exceptions import InvalidParamsError, InvalidCredentialsError
-from jsonrpc.proxy import TestServiceProxy, JsonRpcTestClient
-from jsonrpc.site import validate_params, RpcMethod
-from jsonrpc.types import String, Object, Array, Nil, Number, Any
+from jsonrpc.testclient import JsonRpcTestClient
+from jsonrpc.proxy import TestServiceProxy, ServiceProxy, \
+                          CallFuture, AsyncServiceProxy, TimeoutError, gather
+from jsonrpc.site import validate_params, RpcMethod, request_reader, \
+                         encode_kw, encode_arg11, encode_kw11, PARAM_NORMALIZERS
+from jsonrpc.types import String, Object, Array, Nil, Number, Any, Boolean, \
+                          compile_type
 
 
 # Register JSON-RPC methods
 import jsonrpc.tests.methods
 
 
+def make_request(data='', method='POST', query_string='', **meta):
+    """ Builds a request to pass straight to `JsonRpcSite.dispatch` """
+    if not isinstance(data, basestring):
+        data = json.dumps(data)
+    environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': '/json/',
+        'QUERY_STRING': query_string,
+        'SERVER_NAME': 'testserver',
+        'SERVER_PORT': '80',
+        'CONTENT_TYPE': 'application/json-rpc',
+        'CONTENT_LENGTH': len(data),
+        'wsgi.input': FakePayload(data),
+    }
+    environ.update(meta)
+    return WSGIRequest(environ)
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves a `JsonRpcSite` over HTTP/1.1 on a free local port, for testing
+    clients. `drops` connections are closed without a response first, and
+    connections idle for `idle_timeout` seconds are closed.
+    """
+    daemon_threads = True
+    idle_timeout = None
+
+    def __init__(self, site):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.site = site
+        self.connections = set()
+        self.requests = 0
+        self.drops = 0
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/json/' % self.server_address[1]
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.timeout = self.server.idle_timeout
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def do_POST(self):
+        self.server.connections.add(self.client_address)
+        self.server.requests += 1
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.server.drops > 0:
+            self.server.drops -= 1
+            self.close_connection = 1
+            return
+        meta = dict([('HTTP_' + k.upper().replace('-', '_'), v)
+                     for k, v in self.headers.items()])
+        meta['CONTENT_TYPE'] = self.headers.get('Content-Type', '')
+        response = self.server.site.dispatch(make_request(body, **meta))
+        self.send_response(response.status_code)
+        for header, value in response.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(response.content)))
+        self.end_headers()
+        self.wfile.write(response.content)
+
+    def log_message(self, *args):
+        pass
+
+
 class RpcMethodClassTestCase(unittest.TestCase):
     def setUp(self):
         def no_arg_method():
@@ -95,6 +195,24 @@ class RpcMethodClassTestCase(unittest.TestCase):
             "namespace.rpc_method(String, param2=String) -> String"
         ), signature)
 
+    def test_rpc_method_call_plan(self):
+        wrapped = []
+        def decorator(func):
+            wrapped.append(func)
+            return func
+        rpc_method = RpcMethod(self.add_method, "add(Number, Number)",
+                               decorators=[decorator])
+        plan = rpc_method.compile()
+        self.assertEqual(rpc_method(None, 1, 2), 3)
+        self.assertEqual(rpc_method(None, 3, 4), 7)
+        self.assertEqual(len(wrapped), 1)
+        self.assert_(rpc_method.plan is plan)
+        self.assertEqual(plan.binder.names, ("param1", "param2"))
+        self.assertEqual(plan.binder.required, 2)
+        rpc_method.prepend_argument("username", String)
+        self.assert_(rpc_method.plan is not plan)
+        self.assertEqual(rpc_method.plan.binder.names[0], "username")
+
 
 class JsonRpcFunctionalTestCase(unittest.TestCase):
     def test_validate_args(self):
@@ -130,6 +248,65 @@ class JsonRpcFunctionalTestCase(unittest.TestCase):
         assert Any.kind({}) == Object
         assert Any.kind(None) == Nil
 
+    def test_compiled_types(self):
+        values = [u'', '', 1, 10**30, 1.5, True, None, [], (), set(), {},
+                  SortedDict(), object()]
+        for T in (Any, Object, Number, Boolean, String, Array, Nil,
+                  dict, int, long, bool, str, unicode, list, tuple, float):
+            check = compile_type(T)
+            for value in values:
+                passes = check is None or (type(value) in check[0]) is check[1]
+                self.assertEqual(passes, Any.kind(value) == T,
+                                 "%r as %s" % (value, T))
+
+    def test_validate_args_messages(self):
+        sig = 'jsonrpc(s1=String, s2=Number)'
+        default_site.register(sig, public=True)(lambda r, s1, s2: s1)
+        M = default_site._urls["jsonrpc"]
+        for args, kwargs, message in (
+                ((1, 1), {}, "<type 'int'> is not the correct type s1 for %s" % M.signature),
+                (('a',), {'s2': 'b'}, "<type 'str'> is not the correct type s2 for %s" % M.signature),
+                (('a',), {'s1': 'b'}, 'Ambiguous argument "s1"'),
+                (('a',), {'s3': 1}, 'Missing argument "s2"')):
+            try:
+                validate_params(M, *args, **kwargs)
+            except InvalidParamsError, e:
+                self.assertEqual(e.message, message)
+            else:
+                self.fail("%r %r validated" % (args, kwargs))
+
+    def test_binder(self):
+        bind = RpcMethod(lambda r, a, b=2, c=3: a, "bind").compile().binder
+        self.assertEqual(bind([1, 2], {}), ([1, 2], {}))
+        self.assertEqual(bind([], {"a": 1, "b": 2}), ([1, 2], {}))
+        self.assertEqual(bind([1], {"c": 3}), ([1], {"c": 3}))
+        self.assertEqual(bind([], {"a": 1, "c": 3}), ([1], {"c": 3}))
+        # names the function doesn't take by position stay keyword arguments
+        bind = RpcMethod(lambda r, *args, **kw: args, "varArgs(String, String, str3=String)").compile().binder
+        self.assertEqual(bind(["a"], {"1": "b", "str3": "c"}), (["a"], {"1": "b", "str3": "c"}))
+
+    def test_binder_decorated(self):
+        def by_name(func):
+            def wrapper(request, **kwargs):
+                return func(request, **kwargs)
+            return wrapper
+        def swapped(func):
+            def wrapper(request, b, a):
+                return func(request, a, b)
+            return wrapper
+        method = RpcMethod(lambda r, a, b: a - b, "bind", decorators=[by_name])
+        self.assertEqual(method.compile().binder([], {"a": 3, "b": 1}), ([], {"a": 3, "b": 1}))
+        self.assertEqual(method(None, a=3, b=1), 2)
+        method = RpcMethod(lambda r, a, b: a - b, "bind", decorators=[swapped])
+        self.assertEqual(method.compile().binder([], {"a": 3, "b": 1}), ([], {"a": 3, "b": 1}))
+        self.assertEqual(method(None, a=3, b=1), 2)
+
+    def test_binder_credentials(self):
+        site = JsonRpcSite("binder")
+        site.register("auth")(lambda r, a: a)
+        bind = site._urls["auth"].plan.binder
+        self.assertEqual(bind([], {"username": "u", "password": "p", "a": 1}), (["u", "p", 1], {}))
+
 
 class JsonRpcProtocolTestCase(TestCase):
     def setUp(self):
@@ -145,6 +322,15 @@ class JsonRpcProtocolTestCase(TestCase):
                                                 content_type="application/json-rpc")
         return json.loads(response.content)
 
+    def test_proxy_batch(self):
+        with self.proxy10.batch():
+            echo = self.proxy10.jsonrpc.test("this is a string")
+            auth = self.proxy10.jsonrpc.testAuth("sammeh", "password", "this is a string")
+            fails = self.proxy10.jsonrpc.fails("this is a string")
+        self.assertEqual(echo.result()["result"], "this is a string")
+        self.assertEqual(auth.result()["result"], "this is a string")
+        self.assertEqual(fails.result()["error"]["name"], "OtherError")
+
     def test_10(self):
         self.assertEqual(
             self.proxy10.jsonrpc.test('this is a string')[u'result'], u'this is a string')
@@ -304,3 +490,1194 @@ class JsonRpcProtocolTestCase(TestCase):
         self.assertEqual(response["error"], None)
         self.assertEqual("procs" in response["result"], True)
         self.assertEqual(len(response["result"]["procs"]), 13)
+
+
+class JsonRpcCodecTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = JsonRpcTestClient()
+
+    def test_get_codec(self):
+        self.assert_(get_codec("json") is codecs["json"])
+        self.assert_(get_codec(codecs["json"]) is codecs["json"])
+        self.assertRaises(ValueError, get_codec, "no-such-codec")
+
+    def test_fallback_default(self):
+        site = JsonRpcSite("codecs")
+        default = site.json_default(site.json_encoder)
+        result = {"when": datetime.date(2010, 11, 3),
+                  "price": Decimal("9.99"),
+                  "label": ugettext_lazy("Parse error.")}
+        for name, codec in codecs.items():
+            self.assertEqual(codec.loads(codec.dumps(result, default)),
+                             {"when": "2010-11-03", "price": "9.99",
+                              "label": "Parse error."}, name)
+
+    def test_json_encoder(self):
+        from django.core.serializers.json import DjangoJSONEncoder
+        class Dates(DjangoJSONEncoder):
+            def default(self, o):
+                if isinstance(o, datetime.date):
+                    return o.year
+                return super(Dates, self).default(o)
+        class Compact(DjangoJSONEncoder):
+            def __init__(self, **kwargs):
+                kwargs["separators"] = (",", ":")
+                super(Compact, self).__init__(**kwargs)
+        class Upper(DjangoJSONEncoder):
+            def encode(self, o):
+                return super(Upper, self).encode(o).upper()
+        site = JsonRpcSite("encoders")
+        site.register("today", public=True)(lambda r: datetime.date(2010, 11, 3))
+        request = {"jsonrpc": "2.0", "method": "today", "params": [], "id": 1}
+        for json_encoder, content in ((Dates, '"result": 2010,'),
+                                      (Compact, '"result":"2010-11-03"'),
+                                      (Upper, '"RESULT": "2010-11-03"')):
+            response = site.dispatch(make_request(request), json_encoder=json_encoder)
+            self.assert_(content in response.content, (json_encoder, response.content))
+        self.assert_(site.encoder_codec(site.codec, Dates) is site.codec)
+        self.assert_(site.encoder_codec(site.codec, Upper) is site.encoder_codec(site.codec, Upper))
+
+
+class JsonRpcResponseEncodingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.site = JsonRpcSite("encoding")
+        self.site.register("unsupported", public=True)(lambda r: object())
+        self.site.register("floats", public=True)(lambda r: (1.5, 2.5))
+        self.site.register("decimals", public=True)(lambda r: Decimal("1.5"))
+
+    def call(self, req):
+        response = self.site.dispatch(make_request(req))
+        return response.status_code, json.loads(response.content)
+
+    def test_supported_types(self):
+        status, resp = self.call({"jsonrpc": "2.0", "method": "floats",
+                                  "params": [], "id": 1})
+        self.assertEqual(status, 200)
+        self.assertEqual(resp["result"], [1.5, 2.5])
+        status, resp = self.call({"jsonrpc": "2.0", "method": "decimals",
+                                  "params": [], "id": 1})
+        self.assertEqual(resp["result"], "1.5")
+
+    def test_unsupported_type(self):
+        status, resp = self.call({"jsonrpc": "2.0", "method": "unsupported",
+                                  "params": [], "id": 1})
+        self.assertEqual(status, 500)
+        self.assertEqual(resp["id"], 1)
+        self.assertEqual(resp["result"], None)
+        self.assertEqual(resp["error"]["name"], "OtherError")
+        self.assert_("Return type not supported" in resp["error"]["message"])
+        status, resp = self.call({"version": "1.1", "method": "unsupported",
+                                  "params": [], "id": 1})
+        self.assert_("result" not in resp)
+        self.assertEqual(resp["error"]["name"], "OtherError")
+
+    def test_unsupported_type_in_batch(self):
+        status, resp = self.call([
+            {"jsonrpc": "2.0", "method": "floats", "params": [], "id": 1},
+            {"jsonrpc": "2.0", "method": "unsupported", "params": [], "id": 2},
+            {"jsonrpc": "2.0", "method": "decimals", "params": [], "id": 3}])
+        self.assertEqual(status, 200)
+        self.assertEqual([r["id"] for r in resp], [1, 2, 3])
+        self.assertEqual(resp[0]["result"], [1.5, 2.5])
+        self.assertEqual(resp[1]["error"]["name"], "OtherError")
+        self.assertEqual(resp[2]["result"], "1.5")
+
+
+class JsonRpcBatchExecutorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.executor = ThreadedExecutor(max_workers=4)
+        self.site = JsonRpcSite("batches", batch_executor=self.executor)
+        self.threads = []
+        def sleep(request, n):
+            time.sleep(0.1)
+            self.threads.append(threading.current_thread())
+            return n
+        self.site.register("sleep", public=True)(sleep)
+        self.site.register("serialSleep", public=True, concurrent=False)(sleep)
+
+    def tearDown(self):
+        self.executor.close()
+
+    def call(self, req):
+        return json.loads(self.site.dispatch(make_request(req)).content)
+
+    def test_concurrent_batch(self):
+        req = [{"jsonrpc": "2.0", "method": "sleep", "params": [i], "id": i}
+               for i in range(8)]
+        start = time.time()
+        resp = self.call(req)
+        self.assert_(time.time() - start < 0.5)
+        self.assertEqual([r["result"] for r in resp], range(8))
+        self.assertEqual([r["id"] for r in resp], range(8))
+        self.assert_(threading.current_thread() not in self.threads)
+
+    def test_non_concurrent_methods(self):
+        req = [{"jsonrpc": "2.0", "method": "serialSleep", "params": [i], "id": i}
+               for i in range(2)]
+        req.append({"jsonrpc": "2.0", "method": "nope", "params": [], "id": 2})
+        req.append(1)
+        resp = self.call(req)
+        self.assertEqual([r["result"] for r in resp[:2]], [0, 1])
+        self.assertEqual(resp[2]["error"]["name"], "MethodNotFoundError")
+        self.assertEqual(resp[3]["error"]["name"], "OtherError")
+        self.assertEqual(self.threads, [threading.current_thread()] * 2)
+
+
+class JsonRpcStreamingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.site = JsonRpcSite("streaming", stream_batches=True)
+        self.site.register("echo", public=True)(lambda r, s: s)
+        self.site.register("fails", public=True)(lambda r: 1 / 0)
+        self.site.register("unsupported", public=True)(lambda r: object())
+
+    def test_stream_batch(self):
+        req = [{"jsonrpc": "2.0", "method": "echo", "params": [i], "id": i}
+               for i in range(3)]
+        req.insert(1, {"jsonrpc": "2.0", "method": "fails", "params": [], "id": "f"})
+        req.insert(3, {"jsonrpc": "2.0", "method": "unsupported", "params": [], "id": "u"})
+        response = self.site.dispatch(make_request(req))
+        self.assertEqual(response.status_code, 200)
+        chunks = list(response)
+        self.assertEqual(len(chunks), len(req) + 2)
+        resp = json.loads(''.join(chunks))
+        self.assertEqual([r["id"] for r in resp], [0, None, 1, "u", 2])
+        self.assertEqual([r["result"] for r in resp[::2]], [0, 1, 2])
+        self.assertEqual(resp[1]["error"]["name"], "OtherError")
+        self.assertEqual(resp[3]["error"]["name"], "OtherError")
+
+    def test_stream_in_transaction(self):
+        managed = []
+        self.site.register("managed", public=True)(lambda r: managed.append(transaction.is_managed()))
+        response = self.site.dispatch(make_request(
+            [{"jsonrpc": "2.0", "method": "managed", "params": [], "id": 1}]))
+        self.assertEqual(managed, [])
+        ''.join(response)
+        self.assertEqual(managed, [EARLY_REQUEST_FINISHED])
+        self.assertFalse(transaction.is_managed())
+
+    def test_stream_empty_batch(self):
+        response = self.site.dispatch(make_request([]))
+        self.assertEqual(json.loads(''.join(response)), [])
+
+    def test_single_requests_are_not_streamed(self):
+        response = self.site.dispatch(make_request(
+            {"jsonrpc": "2.0", "method": "echo", "params": ["x"], "id": 1}))
+        self.assertEqual(json.loads(response.content)["result"], "x")
+
+
+class JsonRpcStreamingRequestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.site = JsonRpcSite("streamingRequests", stream_requests=True)
+        def echo(request, s):
+            self.events.append("call")
+            return s
+        self.site.register("echo", public=True)(echo)
+        self.batch = [{"jsonrpc": "2.0", "method": "echo", "params": [i], "id": i}
+                      for i in range(3)]
+
+    def test_batch(self):
+        response = self.site.dispatch(make_request(self.batch))
+        resp = json.loads(response.content)
+        self.assertEqual([r["result"] for r in resp], [0, 1, 2])
+
+    def test_single_request(self):
+        response = self.site.dispatch(make_request(self.batch[0]))
+        self.assertEqual(json.loads(response.content)["result"], 0)
+
+    def test_entries_run_while_reading(self):
+        request = make_request(self.batch)
+        read = request_reader(request)
+        def recording_read(size):
+            self.events.append("read")
+            return read(size)
+        entries = iter_array(recording_read, chunk_size=16)
+        for entry in entries:
+            self.site.response_dict(request, entry, is_batch=True)
+        self.assertEqual(self.events.count("call"), 3)
+        self.assert_("read" in self.events[self.events.index("call"):])
+
+    def test_malformed_batch(self):
+        body = json.dumps(self.batch)[:-5]
+        resp = json.loads(self.site.dispatch(make_request(body)).content)
+        self.assertEqual(resp["error"]["name"], "ParseError")
+        resp = json.loads(self.site.dispatch(make_request("[1, 2")).content)
+        self.assertEqual(resp["error"]["name"], "ParseError")
+        resp = json.loads(self.site.dispatch(make_request("{")).content)
+        self.assertEqual(resp["error"]["name"], "InvalidRequestError")
+
+    def test_malformed_streamed_batch(self):
+        self.site.stream_batches = True
+        body = json.dumps(self.batch)[:-5]
+        resp = json.loads(''.join(self.site.dispatch(make_request(body))))
+        self.assertEqual([r["result"] for r in resp[:2]], [0, 1])
+        self.assertEqual(resp[2]["error"]["name"], "ParseError")
+
+
+class AuthenticationCacheTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='cached', email='c@rf.com', password='password')
+        self.calls = []
+        def counting_authenticate(**credentials):
+            self.calls.append(credentials)
+            return authenticate(**credentials)
+        self.cache = AuthenticationCache(max_size=2, ttl=60, authenticate=counting_authenticate)
+
+    def test_cached(self):
+        self.assertEqual(self.cache.authenticate(username='cached', password='password'), self.user)
+        self.assertEqual(self.cache.authenticate(username='cached', password='password'), self.user)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.cache.authenticate(username='cached', password='wrong'), None)
+        self.assertEqual(self.cache.authenticate(username='cached', password='wrong'), None)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_plaintext_not_stored(self):
+        self.cache.authenticate(username='cached', password='password')
+        self.assert_('password' not in repr(self.cache.__dict__))
+
+    def test_ttl(self):
+        self.cache.ttl = -1
+        self.cache.authenticate(username='cached', password='password')
+        self.cache.authenticate(username='cached', password='password')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_max_size(self):
+        for i in range(3):
+            User.objects.create_user(username='cached%d' % i, email='c@rf.com', password='password')
+            self.cache.authenticate(username='cached%d' % i, password='password')
+        self.assertEqual(len(self.cache._entries), 2)
+        self.cache.authenticate(username='cached2', password='password')
+        self.assertEqual(len(self.calls), 3)
+
+    def test_invalidated_on_save(self):
+        self.cache.authenticate(username='cached', password='password')
+        self.user.set_password('changed')
+        self.user.save()
+        self.assertEqual(self.cache.authenticate(username='cached', password='password'), None)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_shared_invalidation(self):
+        shared = get_cache('locmem://')
+        caches = [AuthenticationCache(authenticate=self.cache._authenticate, cache=shared)
+                  for process in range(2)]
+        for cache in caches:
+            cache.authenticate(username='cached', password='password')
+        self.assertEqual(len(self.calls), 2)
+        # both caches see the save, as if they were in different processes
+        caches[0].invalidate_user(self.user)
+        for cache in caches:
+            cache.authenticate(username='cached', password='password')
+        self.assertEqual(len(self.calls), 4)
+        caches[1].authenticate(username='cached', password='password')
+        self.assertEqual(len(self.calls), 4)
+
+    def test_site(self):
+        site = JsonRpcSite("authCache", auth_cache=self.cache)
+        site.register("whoami")(lambda request: request.user.username)
+        for i in range(2):
+            resp = json.loads(site.dispatch(make_request(
+                {"method": "whoami", "params": ["cached", "password"], "id": i})).content)
+            self.assertEqual(resp["result"], "cached")
+        self.assertEqual(len(self.calls), 1)
+
+
+class BatchAuthenticationTestCase(TestCase):
+    def setUp(self):
+        User.objects.create_user(username='batched', email='b@rf.com', password='password')
+        self.calls = []
+        def counting_authenticate(**credentials):
+            self.calls.append(credentials)
+            return authenticate(**credentials)
+        self.site = JsonRpcSite("batchAuth")
+        self.site.register("whoami", authenticator=counting_authenticate)(
+            lambda request: request.user.username)
+
+    def call(self, req):
+        return json.loads(self.site.dispatch(make_request(req)).content)
+
+    def test_batch_authenticates_once(self):
+        req = [{"jsonrpc": "2.0", "method": "whoami", "params": ["batched", "password"], "id": i}
+               for i in range(5)]
+        req += [{"jsonrpc": "2.0", "method": "whoami", "params": ["batched", "wrong"], "id": i}
+                for i in range(5, 7)]
+        resp = self.call(req)
+        self.assertEqual([r["result"] for r in resp[:5]], ["batched"] * 5)
+        self.assertEqual([r["error"]["name"] for r in resp[5:]],
+                         ["InvalidCredentialsError"] * 2)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_separate_requests(self):
+        req = {"jsonrpc": "2.0", "method": "whoami", "params": ["batched", "password"], "id": 1}
+        self.call(req)
+        self.call(req)
+        self.assertEqual(len(self.calls), 2)
+
+
+class HttpCachingTestCase(TestCase):
+    def setUp(self):
+        self.calls = []
+        def lookup(request, key):
+            self.calls.append(key)
+            return {"key": key}
+        self.site = JsonRpcSite("httpCaching")
+        self.site.register("lookup", public=True, idempotent=True, etag=True,
+                           max_age=300, vary=["Accept-Language"])(lookup)
+        self.site.register("validated", public=True, idempotent=True,
+                           etag=lambda request, key: "v1-%s" % key)(lookup)
+        self.site.register("uncached", public=True, idempotent=True)(lookup)
+        User.objects.create_user(username='validated', email='v@rf.com', password='password')
+
+    def get(self, method, **meta):
+        return self.site.dispatch(make_request(method='GET', query_string='key=a', **meta),
+                                  method=method)
+
+    def test_computed_etag(self):
+        response = self.get("lookup")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Cache-Control"], "max-age=300")
+        self.assertEqual(response["Vary"], "Accept-Language")
+        etag = response["ETag"]
+        response = self.get("lookup", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, "")
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(response["Cache-Control"], "max-age=300")
+        self.assertEqual(self.get("lookup", HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_validator(self):
+        response = self.get("validated")
+        self.assertEqual(response["ETag"], '"v1-a"')
+        self.assertEqual(self.calls, ["a"])
+        response = self.get("validated", HTTP_IF_NONE_MATCH='"v1-a"')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.calls, ["a"])
+
+    def test_authenticated_validator(self):
+        validated = []
+        def etag(request, key):
+            validated.append((request.user.username, key))
+            return "v1-%s" % key
+        self.site.register("private", idempotent=True, etag=etag)(lambda request, key: key)
+        response = self.site.dispatch(make_request(method='GET', HTTP_IF_NONE_MATCH='"v1-a"',
+                                      query_string='username=validated&password=wrong&key=a'),
+                                      method="private")
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(json.loads(response.content)["error"]["name"], "InvalidCredentialsError")
+        self.assertEqual(validated, [])
+        response = self.site.dispatch(make_request(method='GET', HTTP_IF_NONE_MATCH='"v1-a"',
+                                      query_string='username=validated&password=password&key=a'),
+                                      method="private")
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(validated, [("validated", "a")])
+
+    def test_uncached(self):
+        response = self.get("uncached")
+        self.assertEqual(response.status_code, 200)
+        self.assert_(not response.has_header("ETag"))
+        self.assert_(not response.has_header("Cache-Control"))
+
+    def test_post_is_not_cached(self):
+        response = self.site.dispatch(make_request(
+            {"jsonrpc": "2.0", "method": "lookup", "params": ["a"], "id": 1}))
+        self.assert_(not response.has_header("ETag"))
+
+
+class ResultCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        def lookup(request, key):
+            self.calls.append(key)
+            time.sleep(0.05)
+            return {"key": key}
+        self.lookup = lookup
+
+    def make_site(self, result_cache):
+        site = JsonRpcSite("resultCache", result_cache=result_cache)
+        for name in ("catalog.get", "catalog.list", "config.get"):
+            site.register(name, public=True, idempotent=True, cache_timeout=60)(self.lookup)
+        site.register("uncached", public=True, idempotent=True)(self.lookup)
+        return site
+
+    def call(self, site, method, key):
+        return json.loads(site.dispatch(make_request(
+            {"jsonrpc": "2.0", "method": method, "params": [key], "id": 1})).content)["result"]
+
+    def check_site(self, site):
+        self.assertEqual(self.call(site, "catalog.get", "a"), {"key": "a"})
+        self.assertEqual(self.call(site, "catalog.get", "a"), {"key": "a"})
+        self.call(site, "catalog.get", "b")
+        self.call(site, "uncached", "a")
+        self.call(site, "uncached", "a")
+        self.assertEqual(self.calls, ["a", "b", "a", "a"])
+        self.call(site, "catalog.list", "a")
+        self.call(site, "config.get", "a")
+        site.invalidate_results(prefix="catalog.")
+        self.call(site, "catalog.get", "a")
+        self.call(site, "catalog.list", "a")
+        self.call(site, "config.get", "a")
+        self.assertEqual(len(self.calls), 8)
+        site.invalidate_results(method="config.get")
+        self.call(site, "config.get", "a")
+        self.assertEqual(len(self.calls), 9)
+
+    def check_stampede(self, site):
+        threads = [threading.Thread(target=self.call, args=(site, "catalog.get", "x"))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.calls, ["x"])
+
+    def test_locmem(self):
+        self.check_site(self.make_site(LocMemResultCache()))
+
+    def test_locmem_stampede(self):
+        self.check_stampede(self.make_site(LocMemResultCache()))
+
+    def test_locmem_max_size(self):
+        cache = LocMemResultCache(max_size=2)
+        for key in "abca":
+            cache.get_or_call("m", key, lambda: self.calls.append(key), 60)
+        self.assertEqual(self.calls, list("abca"))
+        self.assertEqual(len(cache._entries), 2)
+
+    def test_locmem_hung_call(self):
+        cache = LocMemResultCache(lock_timeout=0.1)
+        release = threading.Event()
+        hung = threading.Thread(target=cache.get_or_call,
+                                args=("m", "k", lambda: release.wait(5), 60))
+        hung.start()
+        time.sleep(0.02)
+        try:
+            start = time.time()
+            self.assertEqual(cache.get_or_call("m", "k", lambda: "computed", 60), "computed")
+            self.assert_(time.time() - start < 1)
+        finally:
+            release.set()
+            hung.join()
+
+    def test_django_cache(self):
+        self.check_site(self.make_site(DjangoResultCache(get_cache("locmem://"))))
+
+    def test_django_cache_stampede(self):
+        self.check_stampede(self.make_site(DjangoResultCache(get_cache("locmem://"))))
+
+    def test_cache_timeout_requires_idempotent(self):
+        site = JsonRpcSite("resultCache")
+        self.assertRaises(ValueError, site.register("m", public=True, cache_timeout=60), self.lookup)
+        self.assertRaises(ValueError, site.register("m", idempotent=True, cache_timeout=60), self.lookup)
+
+
+class ServiceDescriptionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.site = JsonRpcSite("description")
+        self.site.register("echo", public=True)(lambda r, s: s)
+
+    def get_describe(self, **meta):
+        return self.site.dispatch(make_request(method='GET', **meta), method="system.describe")
+
+    def test_cached(self):
+        described = self.site._described()
+        self.assert_(self.site._described() is described)
+        etag = self.site.describe_etag(None)
+        self.site.register("echo2", public=True)(lambda r, s: s)
+        self.assert_(self.site._described() is not described)
+        self.assertEqual(len(self.site.service_desc()["procs"]), 3)
+        self.assertNotEqual(self.site.describe_etag(None), etag)
+
+    def test_serialized_once(self):
+        dumped = []
+        class CountingCodec(type(self.site.codec)):
+            def dumps(self, obj, default=None):
+                dumped.append(obj)
+                return super(CountingCodec, self).dumps(obj, default)
+        self.site.codec = CountingCodec()
+        for i in range(3):
+            self.assertEqual(len(json.loads(self.get_describe().content)["result"]["procs"]), 2)
+        self.assertEqual(len([obj for obj in dumped if "procs" in obj]), 1)
+
+    def test_not_shared(self):
+        self.site.service_desc()["procs"].pop()
+        self.site.instrumentation = Instrumentation(post_call=[
+            lambda request, timer: self.site.service_desc()["procs"].pop()])
+        for i in range(2):
+            self.assertEqual(len(json.loads(self.get_describe().content)["result"]["procs"]), 2)
+
+    def test_etag(self):
+        response = self.get_describe()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)["result"]["procs"]), 2)
+        response = self.get_describe(HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.site.register("echo2", public=True)(lambda r, s: s)
+        self.assertEqual(self.get_describe(HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 200)
+
+    def test_documentation_etag(self):
+        etag = self.get_describe()["ETag"]
+        response = self.site.documentation(make_request(method='GET', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+
+class MethodNotFoundTestCase(unittest.TestCase):
+    def make_site(self, method_not_found):
+        site = JsonRpcSite("notFound", method_not_found=method_not_found)
+        for name in ("catalog.get", "catalog.list", "config.get"):
+            site.register(name, public=True)(lambda r: None)
+        return site
+
+    def error(self, site, method):
+        resp = json.loads(site.dispatch(make_request(
+            {"jsonrpc": "2.0", "method": method, "params": [], "id": 1})).content)
+        self.assertEqual(resp["error"]["name"], "MethodNotFoundError")
+        return resp["error"]["message"]
+
+    def test_brief(self):
+        site = self.make_site("brief")
+        self.assertEqual(self.error(site, "catalog.gte"),
+                         'MethodNotFoundError: Method "catalog.gte" not found.')
+        self.assert_(len(self.error(site, "x" * 10000)) < 200)
+
+    def test_suggest(self):
+        site = self.make_site("suggest")
+        self.assertEqual(self.error(site, "catalog.gte"), 'MethodNotFoundError: '
+                         'Method "catalog.gte" not found. Did you mean: catalog.get?')
+        self.assert_(self.error(site, "Catalog.List").endswith("Did you mean: catalog.list?"))
+        self.assert_(self.error(site, "catalog.gett").endswith("Did you mean: catalog.get?"))
+        self.assert_(self.error(site, "nothing.like.it").endswith("not found."))
+        self.assertEqual(site.suggest_methods("confi.get"), ["config.get"])
+        self.assertEqual(site.suggest_methods("cofnig.get"), ["config.get"])
+        site.register("abc", public=True)(lambda r: None)
+        self.assertEqual(site.suggest_methods("bca"), [])
+        self.assertEqual(site.suggest_methods("ABD"), ["abc"])
+
+    def test_list(self):
+        site = self.make_site("list")
+        self.assert_("config.get" in self.error(site, "nope"))
+
+    def test_invalid_strategy(self):
+        self.assertRaises(ValueError, JsonRpcSite, "notFound", method_not_found="all")
+
+
+class MethodTimeoutTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cancelled = []
+        def sleep(request, seconds):
+            if request.jsonrpc_cancelled.wait(seconds):
+                self.cancelled.append(seconds)
+            return seconds
+        self.site = JsonRpcSite("timeouts", timeout=0.2)
+        self.site.register("sleep", public=True, timeout=True)(sleep)
+        self.site.register("quickSleep", public=True, timeout=0.05)(sleep)
+        self.site.register("fails", public=True, timeout=True)(lambda r: 1 / 0)
+        self.site.register("unlimited", public=True, timeout=0)(lambda r, s: time.sleep(s) or s)
+        self.site.register("untimed", public=True)(
+            lambda r: [threading.current_thread() is self.thread, r.jsonrpc_cancelled.is_set()])
+        self.site.register("language", public=True, timeout=True)(
+            lambda r: translation.get_language())
+        def poll(request, seconds):
+            deadline = time.time() + seconds
+            while time.time() < deadline:
+                if request.jsonrpc_cancelled.is_set():
+                    self.cancelled.append(seconds)
+                    break
+                time.sleep(0.01)
+        self.site.register("poll", public=True, timeout=True)(poll)
+        self.site.register("inline", public=True, concurrent=False)(
+            lambda r: threading.current_thread() is self.thread)
+
+    def call(self, method, *params):
+        response = self.site.dispatch(make_request(
+            {"jsonrpc": "2.0", "method": method, "params": params, "id": 1}))
+        return response.status_code, json.loads(response.content)
+
+    def test_timeout(self):
+        start = time.time()
+        status, resp = self.call("sleep", 5)
+        self.assert_(time.time() - start < 1)
+        self.assertEqual(status, 504)
+        self.assertEqual(resp["error"]["name"], "MethodTimeoutError")
+        self.assertEqual(resp["error"]["code"], -32000)
+        time.sleep(0.05) # the method notices it was cancelled in the background
+        self.assertEqual(self.cancelled, [5])
+
+    def test_within_timeout(self):
+        self.assertEqual(self.call("sleep", 0.01)[1]["result"], 0.01)
+        self.assertEqual(self.call("fails")[1]["error"]["name"], "OtherError")
+
+    def test_method_timeouts(self):
+        self.assertEqual(self.call("quickSleep", 0.1)[1]["error"]["name"], "MethodTimeoutError")
+        self.assertEqual(self.call("unlimited", 0.3)[1]["result"], 0.3)
+
+    def test_opt_in(self):
+        self.thread = threading.current_thread()
+        self.assertEqual(self.call("untimed")[1]["result"], [True, False])
+        self.assertEqual(self.call("unlimited", 0.3)[1]["result"], 0.3)
+
+    def test_language(self):
+        translation.activate("de")
+        try:
+            self.assertEqual(self.call("language")[1]["result"], "de")
+        finally:
+            translation.deactivate()
+
+    def test_busy(self):
+        self.site.timeout_executor = TimeoutExecutor(max_threads=1)
+        self.assertEqual(self.call("poll", 0.5)[1]["error"]["name"], "MethodTimeoutError")
+        status, resp = self.call("sleep", 0.01) # the call that timed out runs on
+        self.assertEqual(status, 503)
+        self.assertEqual(resp["error"]["name"], "ServerBusyError")
+        time.sleep(0.05) # until it noticed it was cancelled
+        self.assertEqual(self.call("sleep", 0.01)[1]["result"], 0.01)
+
+    def test_not_concurrent(self):
+        self.thread = threading.current_thread()
+        self.assertEqual(self.call("inline")[1]["result"], True)
+        self.assertRaises(ValueError, self.site.register("slow", concurrent=False, timeout=1),
+                          lambda r: None)
+
+    def test_batch(self):
+        req = [{"jsonrpc": "2.0", "method": "sleep", "params": [s], "id": s}
+               for s in (0.01, 5, 0.02)]
+        resp = json.loads(self.site.dispatch(make_request(req)).content)
+        self.assertEqual(resp[0]["result"], 0.01)
+        self.assertEqual(resp[1]["error"]["name"], "MethodTimeoutError")
+        self.assertEqual(resp[2]["result"], 0.02)
+
+    def test_batch_cancellation(self):
+        req = [{"jsonrpc": "2.0", "method": "poll", "params": [5], "id": 1},
+               {"jsonrpc": "2.0", "method": "sleep", "params": [0.1], "id": 2}]
+        self.site.dispatch(make_request(req))
+        time.sleep(0.05)
+        # the next entry didn't replace the Event of the one that timed out
+        self.assertEqual(self.cancelled, [5])
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.started = []
+        self.finished = []
+        self.instrumentation = Instrumentation(
+            pre_call=[lambda request, name: self.started.append(name)],
+            post_call=[lambda request, timer: self.finished.append(timer)])
+        self.site = JsonRpcSite("instrumented", instrumentation=self.instrumentation)
+        self.site.register("add", public=True)(lambda r, a, b: a + b)
+        self.site.register("fails", public=True)(lambda r: 1 / 0)
+
+    def call(self, data):
+        return self.site.dispatch(make_request(data))
+
+    def test_phases(self):
+        self.call({"jsonrpc": "2.0", "method": "add", "params": [1, 2], "id": 1})
+        self.assertEqual(self.started, [u"add"])
+        timer, = self.finished
+        self.assertEqual(timer.method, u"add")
+        self.assertFalse(timer.error)
+        self.assertEqual(sorted(timer.timings), sorted(["parse", "normalize",
+            "validate", "execute", "serialize", "total"]))
+        self.assert_(timer.timings["total"] >= sum([t for p, t in
+            timer.timings.items() if p != "total"]))
+
+    def test_errors(self):
+        self.call({"jsonrpc": "2.0", "method": "fails", "params": [], "id": 1})
+        self.call({"jsonrpc": "2.0", "method": "nope", "params": [], "id": 1})
+        self.call("{")
+        self.assertEqual([(t.method, t.error) for t in self.finished],
+                         [(u"fails", True), (u"(unknown)", True), (u"(unknown)", True)])
+
+    def test_batch(self):
+        self.call([{"jsonrpc": "2.0", "method": "add", "params": [1, i], "id": i}
+                   for i in range(3)])
+        self.assertEqual([t.method for t in self.finished],
+                         [u"(batch)", u"add", u"add", u"add"])
+        self.assertEqual(sorted(self.finished[0].timings), ["parse", "total"])
+        self.assert_("serialize" in self.finished[1].timings)
+
+    def test_prometheus(self):
+        self.call({"jsonrpc": "2.0", "method": "add", "params": [1, 2], "id": 1})
+        self.call({"jsonrpc": "2.0", "method": "fails", "params": [], "id": 2})
+        response = self.site.metrics(make_request(method="GET"))
+        self.assert_(response["Content-Type"].startswith("text/plain"))
+        lines = response.content.splitlines()
+        self.assert_('jsonrpc_calls_total{method="add",outcome="ok"} 1' in lines)
+        self.assert_('jsonrpc_calls_total{method="fails",outcome="error"} 1' in lines)
+        self.assert_('jsonrpc_phase_seconds_count{method="add",phase="execute"} 1' in lines)
+        self.assert_('jsonrpc_phase_seconds_bucket{method="add",phase="total",le="+Inf"} 1' in lines)
+
+    def test_disabled(self):
+        from django.http import Http404
+        site = JsonRpcSite("uninstrumented")
+        self.assertRaises(Http404, site.metrics, make_request(method="GET"))
+
+
+class ProfilerTestCase(unittest.TestCase):
+    def make_site(self, profiler):
+        site = JsonRpcSite("profiled", profiler=profiler)
+        site.register("sleep", public=True)(lambda r, s: time.sleep(s) or s)
+        site.register("add", public=True)(lambda r, a, b: a + b)
+        return site
+
+    def call(self, site, method, *params):
+        return site.dispatch(make_request(
+            {"jsonrpc": "2.0", "method": method, "params": params, "id": 1}))
+
+    def test_cprofile(self):
+        profiler = CProfileProfiler(rate=1)
+        site = self.make_site(profiler)
+        self.call(site, "add", 1, 2)
+        self.call(site, "add", 3, 4)
+        self.call(site, "nope")
+        self.assertEqual(profiler.methods(), [u"(unknown)", u"add"])
+        calls = [stats[1] for (filename, line, name), stats in
+                 profiler.stats(u"add").stats.items() if name == "_response_dict"]
+        self.assertEqual(calls, [2])
+
+    def test_sampling(self):
+        profiler = SamplingProfiler(rate=1, interval=0.001)
+        site = self.make_site(profiler)
+        self.call(site, "sleep", 0.05)
+        self.assertEqual(profiler.methods(), [u"sleep"])
+        lines = profiler.collapsed(u"sleep").splitlines()
+        self.assert_(lines)
+        self.assert_([l for l in lines if "_response_dict (site.py:" in l])
+
+    def test_timeout(self):
+        def nap(request, seconds):
+            time.sleep(seconds)
+            return seconds
+        for profiler in (CProfileProfiler(rate=1), SamplingProfiler(rate=1, interval=0.001)):
+            site = JsonRpcSite("profiledTimeout", profiler=profiler, timeout=5)
+            site.register("nap", public=True, timeout=True)(nap)
+            self.assertEqual(json.loads(self.call(site, "nap", 0.05).content)["result"], 0.05)
+            self.assertEqual(profiler.methods(), [u"nap"])
+            if isinstance(profiler, CProfileProfiler):
+                names = [name for filename, line, name in profiler.stats(u"nap").stats]
+            else:
+                names = profiler.collapsed(u"nap")
+            self.assert_("nap" in names)
+            self.assert_("join" not in names)
+
+    def test_rate(self):
+        profiler = CProfileProfiler(rate=0)
+        self.call(self.make_site(profiler), "add", 1, 2)
+        self.assertEqual(profiler.methods(), [])
+
+    def test_dump(self):
+        import os, shutil, tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            cprofile, sampling = CProfileProfiler(rate=1), SamplingProfiler(rate=1)
+            self.call(self.make_site(cprofile), "add", 1, 2)
+            self.call(self.make_site(sampling), "sleep", 0.02)
+            cprofile.dump(directory)
+            sampling.dump(directory)
+            self.assertEqual(sorted(os.listdir(directory)), ["add.prof", "sleep.folded"])
+        finally:
+            shutil.rmtree(directory)
+
+
+class ParamNormalizerTestCase(unittest.TestCase):
+    legacy = {"2.0": lambda p: ([], encode_kw(p)) if type(p) is dict else (p, {}),
+              "1.1": lambda p: (encode_arg11(p), encode_kw(encode_kw11(p))),
+              "1.0": lambda p: (p, {})}
+    keys = ["a", "b", u"c", "0", "1", "2", "10", "-1", "01", " 1", "+3", "1.5", "x_y"]
+
+    def random_params(self, rnd):
+        kind = rnd.randint(0, 9)
+        if kind == 0:
+            return rnd.choice([None, 1, u"abc", True])
+        values = [rnd.choice([None, 1, 2.5, u"s", [1], {"n": 1}])
+                  for _ in xrange(rnd.randint(0, 6))]
+        if kind < 4:
+            return values
+        return dict(zip(rnd.sample(self.keys, len(values)), values))
+
+    def outcome(self, normalize, params):
+        try:
+            args, kwargs = normalize(params)
+        except Exception, e:
+            return type(e)
+        return list(args) if type(args) is tuple else args, kwargs
+
+    def test_equivalence(self):
+        rnd = random.Random(1234)
+        for _ in xrange(2000):
+            params = self.random_params(rnd)
+            for version, normalize in PARAM_NORMALIZERS.items():
+                self.assertEqual(self.outcome(normalize, params),
+                                 self.outcome(self.legacy[version], params),
+                                 "%s params %r" % (version, params))
+
+    def test_no_copies(self):
+        params = {"a": 1}
+        self.assert_(PARAM_NORMALIZERS["2.0"](params)[1] is params)
+        params = [1, 2]
+        self.assert_(PARAM_NORMALIZERS["2.0"](params)[0] is params)
+        self.assert_(PARAM_NORMALIZERS["1.1"](params)[0] is params)
+
+
+class ServiceProxyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.site = JsonRpcSite("proxied")
+        self.site.register("math.add", public=True)(lambda r, a, b: a + b)
+        self.site.register("echo", public=True)(lambda r, s: s)
+        self.server = StandInServer(self.site)
+        self.proxy = ServiceProxy(self.server.url, version='2.0', pool_size=2,
+                                  timeout=5, idempotent=["echo"])
+
+    def tearDown(self):
+        self.proxy.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_call(self):
+        self.assertEqual(self.proxy.math.add(1, 2)["result"], 3)
+        self.assertEqual(self.proxy.math.add(a=1, b=2)["result"], 3)
+        self.assertEqual(self.proxy.nope()["error"]["name"], "MethodNotFoundError")
+        self.assertRaises(ValueError, ServiceProxy(self.server.url).echo, s=1)
+
+    def test_keep_alive(self):
+        for i in range(5):
+            self.assertEqual(self.proxy.echo(i)["result"], i)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_threads(self):
+        results = []
+        def call(i):
+            results.append(self.proxy.math.add(i, i)["result"])
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), [i * 2 for i in range(10)])
+        self.assert_(self.proxy.pool._idle.qsize() <= 2)
+
+    def test_retries(self):
+        self.server.drops = 2
+        self.assertEqual(self.proxy.echo("again")["result"], "again")
+        self.server.drops = 1
+        self.assertRaises(Exception, self.proxy.math.add, 1, 2)
+        self.assertEqual(self.proxy.math.add(1, 2)["result"], 3)
+
+    def test_closed_connections(self):
+        self.server.idle_timeout = 0.1
+        self.assertEqual(self.proxy.math.add(1, 2)["result"], 3)
+        time.sleep(0.3)
+        # not retried, the connection the server closed isn't used again
+        self.assertEqual(self.proxy.math.add(1, 2)["result"], 3)
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_unreachable(self):
+        proxy = ServiceProxy('http://127.0.0.1:1/json/', timeout=1)
+        self.assertRaises(socket.error, proxy.echo, 1)
+
+    def test_batch(self):
+        with self.proxy.batch():
+            add = self.proxy.math.add(1, 2)
+            math = self.proxy.math
+            nope = self.proxy.nope()
+            echo = math.add(a=2, b=3)
+            self.assert_(isinstance(add, CallFuture) and not add.done())
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(add.result()["result"], 3)
+        self.assertEqual(nope.result()["error"]["name"], "MethodNotFoundError")
+        self.assertEqual(echo.result()["result"], 5)
+        self.assertEqual(self.proxy.echo(1)["result"], 1) # no longer batching
+
+    def test_batch_aborted(self):
+        try:
+            with self.proxy.batch():
+                add = self.proxy.math.add(1, 2)
+                raise KeyError
+        except KeyError:
+            pass
+        self.assertRaises(KeyError, add.result)
+        self.assertEqual(self.server.requests, 0)
+
+    def test_auto_batching(self):
+        proxy = ServiceProxy(self.server.url, batch_window=0.1, timeout=5)
+        results = []
+        def call(i):
+            results.append(proxy.math.add(i, 1)["result"])
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        proxy.close()
+        self.assertEqual(sorted(results), [1, 2, 3, 4, 5])
+        self.assert_(self.server.requests < 5)
+        proxy = ServiceProxy(self.server.url, batch_window=10, max_batch=1)
+        self.assertEqual(proxy.echo(u"now")["result"], u"now")
+        proxy.close()
+
+
+class AsyncServiceProxyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.site = JsonRpcSite("proxiedAsync")
+        self.site.register("sleep", public=True)(lambda r, s: time.sleep(s) or s)
+        self.server = StandInServer(self.site)
+        self.proxies = []
+
+    def tearDown(self):
+        for proxy in self.proxies:
+            proxy.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_proxy(self, **kwargs):
+        proxy = AsyncServiceProxy(self.server.url, version='2.0', timeout=5, **kwargs)
+        self.proxies.append(proxy)
+        return proxy
+
+    def test_concurrent(self):
+        proxy = self.make_proxy(max_concurrency=6)
+        start = time.time()
+        futures = [proxy.sleep(0.2) for i in range(6)]
+        self.assert_(time.time() - start < 0.1)
+        self.assertEqual([r["result"] for r in gather(futures, 5)], [0.2] * 6)
+        self.assert_(time.time() - start < 1)
+
+    def test_max_concurrency(self):
+        proxy = self.make_proxy(max_concurrency=2)
+        start = time.time()
+        gather([proxy.sleep(0.1) for i in range(6)], 5)
+        self.assert_(time.time() - start >= 0.3)
+
+    def test_call_timeout(self):
+        proxy = self.make_proxy(call_timeout=0.05)
+        self.assertRaises(TimeoutError, proxy.sleep(0.5).result)
+        self.assertEqual(proxy.sleep(0).result()["result"], 0)
+
+    def test_auto_batching(self):
+        proxy = self.make_proxy(batch_window=0.05)
+        futures = [proxy.sleep(0) for i in range(5)]
+        self.assertEqual([r["result"] for r in gather(futures, 5)], [0] * 5)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_explicit_batch(self):
+        proxy = self.make_proxy()
+        with proxy.batch():
+            futures = [proxy.sleep(0), proxy.nope()]
+        self.assertEqual(futures[0].result()["result"], 0)
+        self.assertEqual(futures[1].result()["error"]["name"], "MethodNotFoundError")
+        self.assertEqual(self.server.requests, 1)
+
+
+class CompressionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.site = JsonRpcSite("compressed", compress_min_size=200)
+        self.site.register("range", public=True)(lambda r, n: range(n))
+        self.streaming = JsonRpcSite("compressedStream", compress_min_size=200,
+                                     stream_batches=True, stream_requests=True)
+        self.streaming.register("range", public=True)(lambda r, n: range(n))
+
+    def call(self, site, data, **meta):
+        response = site.dispatch(make_request(data, **meta))
+        content = ''.join(response)
+        if response.has_header('Content-Encoding'):
+            content = encodings[response['Content-Encoding']].decompress(content)
+        return response, json.loads(content)
+
+    def test_negotiate(self):
+        self.assertEqual(negotiate(""), None)
+        self.assertEqual(negotiate("identity"), None)
+        self.assertEqual(negotiate("gzip, deflate"), "gzip")
+        self.assertEqual(negotiate("deflate;q=1, gzip;q=0.5"), "deflate")
+        self.assertEqual(negotiate("gzip;q=0, deflate;q=0.1"), "deflate")
+        self.assertEqual(negotiate("gzip;q=0, *"), "deflate")
+        self.assertEqual(negotiate("GZIP;Q=0.3"), "gzip")
+
+    def test_encodings(self):
+        data = json.dumps(range(1000))
+        for name, encoding in encodings.items():
+            self.assertEqual(encoding.decompress(encoding.compress(data)), data)
+            self.assertEqual(encoding.decompress(''.join(encoding.compress_stream(
+                [data[:100], data[100:]]))), data)
+            self.assertRaises(ValueError, encoding.decompress, encoding.compress(data), 100)
+            consumed = []
+            def chunks():
+                for chunk in (data[:100], data[100:]):
+                    consumed.append(chunk)
+                    yield chunk
+            stream = encoding.compress_stream(chunks())
+            stream.next()
+            self.assertEqual(len(consumed), 1, "%s buffers streams" % name)
+        raw = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.assertEqual(encodings["deflate"].decompress(raw.compress(data) + raw.flush()), data)
+        read = decompressing_reader(request_reader(make_request(encodings["gzip"].compress(data))), "gzip")
+        self.assertEqual(''.join(iter(lambda: read(7), '')), data)
+
+    def test_response(self):
+        D = {"jsonrpc": "2.0", "method": "range", "params": [100], "id": 1}
+        response, resp = self.call(self.site, D, HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assert_("Accept-Encoding" in response["Vary"])
+        self.assertEqual(resp["result"], range(100))
+        response, resp = self.call(self.site, D)
+        self.assertFalse(response.has_header("Content-Encoding"))
+        D["params"] = [3]
+        response, resp = self.call(self.site, D, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertFalse(response.has_header("Content-Encoding")) # too small
+        self.assertEqual(resp["result"], range(3))
+        self.assert_("Accept-Encoding" in response["Vary"])
+
+    def test_request(self):
+        D = json.dumps({"jsonrpc": "2.0", "method": "range", "params": [3], "id": 1})
+        for site in (self.site, self.streaming):
+            for name, encoding in encodings.items():
+                resp = self.call(site, encoding.compress(D), HTTP_CONTENT_ENCODING=name)[1]
+                self.assertEqual(resp["result"], range(3))
+            resp = self.call(site, "garbage", HTTP_CONTENT_ENCODING="gzip")[1]
+            self.assertEqual(resp["error"]["name"], "InvalidRequestError")
+            resp = self.call(site, D, HTTP_CONTENT_ENCODING="compress")[1]
+            self.assertEqual(resp["error"]["name"], "InvalidRequestError")
+
+    def test_streams(self):
+        batch = [{"jsonrpc": "2.0", "method": "range", "params": [i], "id": i}
+                 for i in range(20)]
+        response, resp = self.call(self.streaming, encodings["deflate"].compress(json.dumps(batch)),
+                                   HTTP_CONTENT_ENCODING="deflate", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual([r["result"] for r in resp], [range(i) for i in range(20)])
+
+    def test_proxy(self):
+        server = StandInServer(self.site)
+        proxy = ServiceProxy(server.url, version="2.0", compress_min_size=10)
+        try:
+            self.assertEqual(proxy.range(500)["result"], range(500))
+        finally:
+            proxy.close()
+            server.shutdown()
+            server.server_close()
+
+
+class NetstringCodec(Codec):
+    """
+    JSON values with arrays of them framed as netstrings, a codec that
+    can't be parsed incrementally and doesn't frame arrays like JSON.
+    """
+    name = 'netstring'
+    content_type = 'application/x-netstring-json'
+    content_types = ('application/x-netstrings',)
+    incremental = False
+
+    def loads(self, data):
+        if not data.startswith('*'):
+            return json.loads(data)
+        items, data = [], data[1:]
+        while data:
+            length, _, data = data.partition(':')
+            items.append(self.loads(data[:int(length)]))
+            if data[int(length)] != ',':
+                raise ValueError('Unterminated netstring')
+            data = data[int(length) + 1:]
+        return items
+
+    def dumps(self, obj, default=None):
+        if type(obj) is list:
+            return self.dumps_array([self.dumps(o, default) for o in obj])
+        return json.dumps(obj, default=default)
+
+    def dumps_array(self, items):
+        return ''.join(self.stream_array(items))
+
+    def stream_array(self, items):
+        yield '*'
+        for item in items:
+            yield '%d:%s,' % (len(item), item)
+
+
+class CodecNegotiationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.codec = NetstringCodec()
+        self.site = JsonRpcSite("negotiated", alternative_codecs=[self.codec])
+        self.site.register("range", public=True)(lambda r, n: range(n))
+        self.streaming = JsonRpcSite("negotiatedStream", alternative_codecs=[self.codec],
+                                     stream_batches=True, stream_requests=True)
+        self.streaming.register("range", public=True)(lambda r, n: range(n))
+
+    def call(self, site, data, **meta):
+        response = site.dispatch(make_request(data, **meta))
+        return response, ''.join(response)
+
+    def test_negotiate(self):
+        json_codec = self.site.codec
+        for content_type, accept, request_codec, response_codec in [
+                ("application/json-rpc", "", json_codec, json_codec),
+                ("application/x-netstring-json", "", self.codec, self.codec),
+                ("Application/X-Netstrings; charset=binary", "*/*", self.codec, self.codec),
+                ("application/json", "application/x-netstring-json", json_codec, self.codec),
+                ("application/x-netstring-json", "application/json", self.codec, json_codec),
+                ("text/plain", "application/json;q=0.5, application/x-netstrings",
+                 json_codec, self.codec),
+                ("application/x-netstring-json", "application/x-netstring-json;q=0, text/html",
+                 self.codec, self.codec)]:
+            request = make_request(CONTENT_TYPE=content_type, HTTP_ACCEPT=accept)
+            self.assertEqual(self.site.request_codec(request), request_codec)
+            self.assertEqual(self.site.response_codec(request, request_codec), response_codec)
+        request = make_request(CONTENT_TYPE="application/x-netstring-json")
+        self.assertEqual(JsonRpcSite("plain").request_codec(request).name, "json")
+
+    def test_call(self):
+        D = self.codec.dumps({"jsonrpc": "2.0", "method": "range", "params": [3], "id": 1})
+        response, content = self.call(self.site, D, CONTENT_TYPE="application/x-netstring-json")
+        self.assertEqual(response["Content-Type"], "application/x-netstring-json")
+        self.assert_("Accept" in response["Vary"])
+        self.assertEqual(self.codec.loads(content)["result"], range(3))
+        response, content = self.call(self.site, D, CONTENT_TYPE="application/x-netstring-json",
+                                      HTTP_ACCEPT="application/json")
+        self.assertEqual(response["Content-Type"], "application/json-rpc")
+        self.assertEqual(json.loads(content)["result"], range(3))
+        response, content = self.call(self.site, "*garbage", CONTENT_TYPE="application/x-netstrings")
+        self.assertEqual(self.codec.loads(content)["error"]["name"], "InvalidRequestError")
+
+    def test_batch(self):
+        batch = [{"jsonrpc": "2.0", "method": "range", "params": [i], "id": i}
+                 for i in range(5)]
+        batch.append({"jsonrpc": "2.0", "method": "nothing", "params": [], "id": 5})
+        for site in (self.site, self.streaming):
+            response, content = self.call(site, self.codec.dumps(batch),
+                                          CONTENT_TYPE="application/x-netstring-json")
+            self.assertEqual(response["Content-Type"], "application/x-netstring-json")
+            self.assert_(content.startswith("*"))
+            resp = self.codec.loads(content)
+            self.assertEqual([r["result"] for r in resp[:5]], [range(i) for i in range(5)])
+            self.assertEqual(resp[5]["error"]["name"], "MethodNotFoundError")
+            response, content = self.call(site, json.dumps(batch),
+                                          HTTP_ACCEPT="application/x-netstring-json")
+            self.assertEqual(len(self.codec.loads(content)), 6)
+
+    def test_proxy(self):
+        server = StandInServer(self.site)
+        proxy = ServiceProxy(server.url, version="2.0", codec=self.codec)
+        try:
+            self.assertEqual(proxy.range(10)["result"], range(10))
+            with proxy.batch():
+                first, second = proxy.range(1), proxy.nothing()
+            self.assertEqual(first.result()["result"], [0])
+            self.assertEqual(second.result()["error"]["name"], "MethodNotFoundError")
+        finally:
+            proxy.close()
+            server.shutdown()
+            server.server_close()
+
+    def test_msgpack(self):
+        if "msgpack" not in codecs: # optional
+            return
+        site = JsonRpcSite("msgpack", alternative_codecs=["msgpack"])
+        site.register("echo", public=True)(lambda r, value: value)
+        msgpack = codecs["msgpack"]
+        value = {u"numbers": [1, 2.5, -3], u"nested": {u"text": u"\xe9t\xe9"}}
+        batch = [{"jsonrpc": "2.0", "method": "echo", "params": [value], "id": i}
+                 for i in range(3)]
+        response, content = self.call(site, msgpack.dumps(batch),
+                                      CONTENT_TYPE="application/msgpack")
+        self.assertEqual(response["Content-Type"], "application/msgpack")
+        self.assertEqual([r["result"] for r in msgpack.loads(content)], [value] * 3)
+        site.register("day", public=True)(lambda r: datetime.date(2010, 1, 2))
+        D = msgpack.dumps({"jsonrpc": "2.0", "method": "day", "params": [], "id": 1})
+        response, content = self.call(site, D, CONTENT_TYPE="application/x-msgpack")
+        self.assertEqual(msgpack.loads(content)["result"], u"2010-01-02")
@@ -0,0 +1,289 @@
+"""
+Micro-benchmarks for the hot paths of the JSON-RPC machinery.
+
+Run them from a configured Django project, ie. from the example project:
+
+    cd example
+    DJANGO_SETTINGS_MODULE=settings python -m jsonrpc.tests.benchmarks
+
+Pass `--json` for results that can be compared between versions, and
+`--filter` to run only the benchmarks whose names contain a string. The
+dispatch benchmarks create a test database for the user of the
+authenticated method, like the test runner does.
+"""
+import sys
+import datetime
+import platform
+from decimal import Decimal
+from optparse import OptionParser
+from timeit import default_timer
+import django
+from django.conf import settings
+from django.conf.urls.defaults import patterns
+from django.http import HttpRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from jsonrpc._json import codecs, fallback_default, dumps
+from jsonrpc.testclient import JsonRpcTestClient
+from jsonrpc.site import JsonRpcSite
+from jsonrpc.types import Any, Object, Number, String, Array, compile_type
+
+
+site = JsonRpcSite("benchmarks")
+
+
+@site.register("bench.echo", public=True)
+def echo(request, a, b):
+    return a + b
+
+
+@site.register("bench.typedEcho(a=String, b=String) -> String", public=True)
+def typed_echo(request, a, b):
+    return a + b
+
+
+@site.register("bench.authEcho")
+def auth_echo(request, a, b):
+    return a + b
+
+
+@site.register("bench.rows", public=True)
+def rows(request, count):
+    return result_rows(count)['result']
+
+
+@site.register("bench.fails", public=True)
+def fails(request):
+    raise IndexError
+
+
+urlpatterns = patterns('', (r'^json/$', site.dispatch))
+
+
+def bench(func, number=10000, repeat=3):
+    """
+    Calls `func` `number` times, `repeat` times over, and returns the best
+    time per call in microseconds. A `number` of None is chosen so that
+    each repeat takes at least a tenth of a second.
+    """
+    if number is None:
+        number = calibrate(func)
+    best = None
+    for _ in xrange(repeat):
+        start = default_timer()
+        for _ in xrange(number):
+            func()
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / number * 1e6
+
+
+def calibrate(func, min_time=0.1):
+    """ The number of calls of `func` that take at least `min_time` seconds """
+    number = 1
+    while True:
+        start = default_timer()
+        for _ in xrange(number):
+            func()
+        if default_timer() - start >= min_time:
+            return number
+        number *= 2
+
+
+def types_benchmark(number=10000):
+    """
+    Compares `Any.kind(value) == T` against the compiled checks
+    `validate_params` uses.
+    """
+    cases = [(u'a string', String), (42, Number), ({'a': 1}, Object),
+             ([1, 2, 3], Array), (None, Any), (u'a string', str)]
+    results = []
+    for value, T in cases:
+        check = compile_type(T)
+        def kind():
+            return Any.kind(value) == T
+        def compiled():
+            return check is None or (type(value) in check[0]) is check[1]
+        results.append({
+            'name': 'types.%s.%s' % (type(value).__name__, T.__name__),
+            'kind_us': bench(kind, number),
+            'compiled_us': bench(compiled, number),
+        })
+    return results
+
+
+def result_rows(rows=1000):
+    """
+    A response envelope holding `rows` records shaped like a typical ORM
+    derived result list.
+    """
+    now = datetime.datetime(2010, 11, 3, 12, 30)
+    return {
+        'jsonrpc': '2.0',
+        'id': 'benchmark',
+        'error': None,
+        'result': [{
+            'id': i,
+            'name': u'Record n\xfamero %d' % i,
+            'active': bool(i % 2),
+            'score': i * 0.75,
+            'price': Decimal('%d.99' % i),
+            'created': now + datetime.timedelta(minutes=i),
+            'tags': [u'alpha', u'beta', u'gamma'][:i % 4],
+            'owner': {'id': i % 17, 'username': u'user%d' % (i % 17)},
+        } for i in xrange(rows)],
+    }
+
+
+def codecs_benchmark(number=20, rows=1000):
+    """ Compares serializing `result_rows` with each registered codec """
+    payload = result_rows(rows)
+    default = fallback_default(DjangoJSONEncoder)
+    results = []
+    for name, codec in sorted(codecs.items()):
+        data = codec.dumps(payload, default)
+        results.append({
+            'name': 'codecs.%s' % name,
+            'dumps_us': bench(lambda: codec.dumps(payload, default), number),
+            'loads_us': bench(lambda: codec.loads(data), number),
+            'bytes': len(data),
+        })
+    return results
+
+
+def call(method, params, version='2.0'):
+    """ A request for `method` in the shape of the given protocol version """
+    D = {'method': method, 'params': params, 'id': 1}
+    if version == '2.0':
+        D['jsonrpc'] = version
+    elif version == '1.1':
+        D['version'] = version
+    return D
+
+
+def dispatch_cases():
+    """
+    The requests the dispatch benchmarks send, as (name, request) pairs.
+    Batches are of 2.0 calls of the untyped `bench.echo`.
+    """
+    cases = [
+        ('1.0.list', call('bench.echo', ['a', 'b'], '1.0')),
+        ('1.1.list', call('bench.echo', ['a', 'b'], '1.1')),
+        ('1.1.dict', call('bench.echo', {'a': 'a', 'b': 'b'}, '1.1')),
+        ('2.0.list', call('bench.echo', ['a', 'b'])),
+        ('2.0.dict', call('bench.echo', {'a': 'a', 'b': 'b'})),
+        ('typed.list', call('bench.typedEcho', ['a', 'b'])),
+        ('typed.dict', call('bench.typedEcho', {'a': 'a', 'b': 'b'})),
+        ('auth', call('bench.authEcho', ['bench', 'bench', 'a', 'b'])),
+        ('rows.1000', call('bench.rows', [1000])),
+        ('error.exception', call('bench.fails', [])),
+        ('error.not_found', call('bench.nope', [])),
+        ('error.invalid_params', call('bench.typedEcho', [1, 2])),
+    ]
+    for size in (1, 10, 100, 1000):
+        cases.append(('batch.%d' % size, [dict(call('bench.echo', ['a', 'b']), id=i)
+                                          for i in xrange(size)]))
+    return cases
+
+
+def dispatch_benchmark(number=None, only=None):
+    """
+    Times each of `dispatch_cases` posted through `JsonRpcTestClient`, and
+    the single calls also passed straight to `response_dict`.
+    """
+    client = JsonRpcTestClient()
+    request = HttpRequest()
+    request.method = 'POST'
+    results = []
+    for name, D in dispatch_cases():
+        data = dumps(D)
+        post = lambda: client.post('/json/', data, content_type='application/json-rpc')
+        response = post()
+        cases = [('dispatch.%s' % name, post)]
+        if type(D) is dict:
+            cases.append(('response_dict.%s' % name,
+                          lambda: site.response_dict(request, D)))
+        for name, func in cases:
+            if only and only not in name:
+                continue
+            us = bench(func, number)
+            results.append({
+                'name': name,
+                'us_per_call': us,
+                'calls_per_second': 1e6 / us,
+                'entries': type(D) is list and len(D) or 1,
+                'status': response.status_code,
+                'bytes': len(response.content),
+            })
+    return results
+
+
+def setup_databases():
+    """ Creates a test database holding the user `bench.authEcho` expects """
+    from django.db import connection
+    from django.contrib.auth.models import User
+    old_name = settings.DATABASES['default']['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    User.objects.create_user('bench', 'bench@example.com', 'bench')
+    return old_name
+
+
+def teardown_databases(old_name):
+    from django.db import connection
+    connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def run(only=None, number=None):
+    """ Runs all benchmarks, or those whose names contain `only` """
+    results = []
+    for result in types_benchmark() + codecs_benchmark():
+        if not only or only in result['name']:
+            results.append(result)
+    old_urlconf = settings.ROOT_URLCONF
+    settings.ROOT_URLCONF = 'jsonrpc.tests.benchmarks'
+    old_name = setup_databases()
+    try:
+        results += dispatch_benchmark(number, only)
+    finally:
+        teardown_databases(old_name)
+        settings.ROOT_URLCONF = old_urlconf
+    return results
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'django': django.get_version(),
+        'platform': platform.platform(),
+    }
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [--json] [--filter NAME] [--number N]')
+    parser.add_option('--json', action='store_true', default=False,
+                      help='print the results as a JSON document')
+    parser.add_option('--filter', dest='only', default=None,
+                      help='only run benchmarks whose names contain NAME')
+    parser.add_option('--number', type='int', default=None,
+                      help='calls per repeat of the dispatch benchmarks, '
+                           'calibrated by default')
+    options, args = parser.parse_args(argv)
+    results = run(options.only, options.number)
+    if options.json:
+        print dumps({'environment': environment(), 'results': results},
+                    sort_keys=True, indent=2)
+        return
+    for result in results:
+        if 'kind_us' in result:
+            print '%(name)-28s kind: %(kind_us)8.3fus  compiled: %(compiled_us)8.3fus' % result
+        elif 'dumps_us' in result:
+            print '%(name)-28s dumps: %(dumps_us)10.1fus  loads: %(loads_us)10.1fus  %(bytes)d bytes' % result
+        else:
+            print '%(name)-36s %(us_per_call)12.1fus %(calls_per_second)10.0f/s  %(status)d' % result
+
+
+if __name__ == '__main__':
+    # run the benchmarks from the module the URLconf points to, not __main__
+    from jsonrpc.tests.benchmarks import main
+    main(sys.argv[1:])
@@ -69,3 +69,29 @@ Array = Type('Array', (object,), {}).I(list, set, tuple).N('arr')
 Nil = Type('Nil', (object,), {}).I(type(None)).N('nil')
 Any = Type('Any', (object,), {}).I(
         Object, Number, Boolean, String, Array, Nil).N('any')
+
+
+def compile_type(T):
+    """
+    Compiles the run-time check `Any.kind(value) == T` into a pair
+    `(types, expected)` of precomputed python types so that a value
+    passes when `(type(value) in types) is expected`.
+
+    Returns None when `T` accepts every value.
+    """
+    kinds = dict([(t, Any.kind(t)) for t in _types_gen(Any) if type(t) is type])
+    accepted = frozenset([t for t, kind in kinds.iteritems() if kind == T])
+    if Any.kind(object) == T: # unknown python types are of this kind
+        rejected = frozenset(kinds) - accepted
+        if not rejected:
+            return None
+        return rejected, False
+    return accepted, True
+
+
+def compile_validators(arguments):
+    """
+    Compiles an ordered mapping of argument names to types into a tuple of
+    `(argument name, compiled type)` pairs. See `compile_type`.
+    """
+    return tuple([(name, compile_type(T)) for name, T in arguments.items()])